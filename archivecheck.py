@@ -0,0 +1,123 @@
+"""
+Early sanity checks for downloaded archives and disk images, based only on their first few bytes.
+
+References:
+StuffIt: https://github.com/MacPaw/XADMaster (XADStuffItParser, XADStuffIt5Parser)
+MacBinary: https://files.stairways.com/other/macbinaryii-standard-info.txt
+HFS Master Directory Block: Inside Macintosh: Files, page 2-60
+"""
+
+import os
+import struct
+from typing import Optional
+
+MACBINARY_HEADER_SIZE = 128
+
+STUFFIT_CLASSIC_SIGNATURES = (b'SIT!', b'ST46', b'ST50', b'ST60', b'ST65', b'STin', b'STi2', b'STi3', b'STi4')
+STUFFIT_CLASSIC_SIGNATURE_2 = b'rLau'
+STUFFIT_CLASSIC_HEADER_SIZE = 22
+STUFFIT_5_SIGNATURE = b'StuffIt (c)1997-'
+
+MDB_OFFSET = 1024
+MDB_SIGNATURE_HFS = 0x4244  # 'BD'
+MDB_HEADER_SIZE = 30  # Up to and including drAlBlSt
+
+# How many bytes are needed from the start of each kind of file to check it.
+HEADER_BYTES = {
+    '.sit': MACBINARY_HEADER_SIZE + STUFFIT_CLASSIC_HEADER_SIZE,
+    '.dsk': MDB_OFFSET + MDB_HEADER_SIZE,
+}
+
+
+class InvalidArchive(Exception):
+    pass
+
+
+def macbinary_data_length(header: bytes) -> Optional[int]:
+    """:return: The data fork length if header looks like a MacBinary header, otherwise None."""
+    if len(header) < MACBINARY_HEADER_SIZE:
+        return None
+    if header[0] != 0 or header[74] != 0 or header[82] != 0 or not 1 <= header[1] <= 63:
+        return None
+    return struct.unpack('>I', header[83:87])[0]
+
+
+def check_sit(header: bytes, size: int):
+    offset = 0
+    length = size
+
+    data_length = macbinary_data_length(header)
+    if data_length is not None:
+        offset = MACBINARY_HEADER_SIZE
+        length = data_length
+        if offset + data_length > size:
+            raise InvalidArchive(f'MacBinary data fork of {data_length} bytes runs past the end of the file')
+
+    body = header[offset:]
+    if body.startswith(STUFFIT_5_SIGNATURE):
+        return
+
+    if len(body) < STUFFIT_CLASSIC_HEADER_SIZE:
+        raise InvalidArchive('Too short to be a StuffIt archive')
+    if body[0:4] not in STUFFIT_CLASSIC_SIGNATURES or body[10:14] != STUFFIT_CLASSIC_SIGNATURE_2:
+        raise InvalidArchive('No StuffIt signature')
+
+    archive_length = struct.unpack('>I', body[6:10])[0]
+    if archive_length < STUFFIT_CLASSIC_HEADER_SIZE or archive_length > length:
+        raise InvalidArchive(f'StuffIt header claims {archive_length} bytes, but there are {length}')
+
+
+def check_dsk(header: bytes, size: int):
+    if size % 512 != 0:
+        raise InvalidArchive(f'Disk image size {size} is not a multiple of 512')
+    if len(header) < MDB_OFFSET + MDB_HEADER_SIZE:
+        raise InvalidArchive('Too short to hold an HFS volume')
+
+    mdb = header[MDB_OFFSET:MDB_OFFSET + MDB_HEADER_SIZE]
+    signature, = struct.unpack('>H', mdb[0:2])
+    if signature != MDB_SIGNATURE_HFS:
+        raise InvalidArchive(f'No HFS signature at offset {MDB_OFFSET} (found 0x{signature:04x})')
+
+    allocation_blocks, allocation_block_size = struct.unpack('>HI', mdb[18:24])
+    first_allocation_block, = struct.unpack('>H', mdb[28:30])
+    if allocation_block_size == 0 or allocation_block_size % 512 != 0:
+        raise InvalidArchive(f'Invalid HFS allocation block size {allocation_block_size}')
+    volume_end = first_allocation_block * 512 + allocation_blocks * allocation_block_size
+    if volume_end > size:
+        raise InvalidArchive(f'HFS volume needs {volume_end} bytes, but the image has {size}')
+
+
+CHECKS = {
+    '.sit': check_sit,
+    '.dsk': check_dsk,
+}
+
+
+class ArchiveValidator(object):
+    """
+    Checks the header of a file as its bytes arrive, raising InvalidArchive from feed() as soon as enough of the file is
+    there to tell. Files of a kind without checks are always accepted.
+    """
+
+    def __init__(self, name: str, size: int):
+        _, ext = os.path.splitext(name)
+        ext = ext.lower()
+        self.size = size
+        self.check = CHECKS.get(ext)
+        self.needed = min(HEADER_BYTES.get(ext, 0), size)
+        self.header = b''
+        self.checked = self.check is None
+
+    def feed(self, data: bytes):
+        if self.checked:
+            return
+        self.header += data[:self.needed - len(self.header)]
+        if len(self.header) >= self.needed:
+            self.checked = True
+            self.check(self.header, self.size)
+
+    def finish(self):
+        """Check a file that ended before enough of it arrived to check it while streaming."""
+        if not self.checked:
+            self.checked = True
+            self.check(self.header, self.size)
@@ -0,0 +1,101 @@
+"""
+Benchmarks macftp.py's download path against a local FTP or HTTP stand-in (see ftpstandin.py), for several numbers
+of connections.
+
+Example, 200 files of 256KiB over a link with 50ms of latency and 1MiB/s per connection:
+    python benchmark_macftp.py --files 200 --size 256K --latency 0.05 --bandwidth 1M --connections 1,2,4,8
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+
+import ftpstandin
+import macftp
+import throttle
+
+ROOT = 'Garden/apps'
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument('--files', type=int, default=100, help='Number of files to serve. Default is 100')
+argparser.add_argument('--size', type=throttle.parse_rate, default=256 * 1024, help='Size of each file, e.g. 256K. Default is 256K')
+argparser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every reply and data connection. Default is 0.02')
+argparser.add_argument('--bandwidth', type=throttle.parse_rate, help='Bytes per second for each data connection, e.g. 1M. Default is unlimited')
+argparser.add_argument('--failure-rate', type=float, default=0.0, help='Chance of refusing a session or dropping a transfer')
+argparser.add_argument('--protocol', choices=('ftp', 'http'), default='ftp', help='Protocol the stand-in speaks. Default is ftp')
+argparser.add_argument('--no-mlsd', action='store_true', help='Make the stand-in only support LIST')
+argparser.add_argument('--connections', default='1,2,4,8', help='Comma separated connection counts to benchmark. Default is 1,2,4,8')
+argparser.add_argument('--verbose', '-v', action='store_true', help="Show macftp's output")
+
+
+def run(server: ftpstandin.FTPStandIn, connections: int, verbose: bool) -> dict:
+    """Mirror the stand-in's tree into a temporary directory, verify it, and return macftp's --stats report."""
+    host, port = server.server_address
+    macftp.FTP_URL = host
+    macftp.FTP_PORT = port
+
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            argv = ['--root', ROOT, '--connections', str(connections), '--retries', '20', '--fsync', 'none',
+                    '--stats', 'stats.json']
+            if isinstance(server, ftpstandin.HTTPStandIn):
+                argv += ['--source', f'http://{host}:{port}/']
+            with contextlib.ExitStack() as stack:
+                if not verbose:
+                    stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+                    stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+                macftp.main(argv)
+
+            with open('stats.json') as f:
+                report = json.load(f)
+
+            for path in server.tree.files:
+                with open(os.path.join(macftp.OUTPUT_DIR, path), 'rb') as f:
+                    if f.read() != server.tree.contents(path):
+                        raise ValueError(f'Downloaded {path} does not match the served contents')
+        finally:
+            os.chdir(previous_dir)
+
+    return report
+
+
+def main():
+    args = argparser.parse_args()
+
+    # .sit files below MAX_SIZE, so macftp downloads all of them.
+    files = {f'{ROOT}/File {i:05}.sit': args.size for i in range(args.files)}
+    tree = ftpstandin.SyntheticTree(files)
+    server_class = ftpstandin.HTTPStandIn if args.protocol == 'http' else ftpstandin.FTPStandIn
+    server = server_class(tree, latency=args.latency, bandwidth=args.bandwidth,
+                          failure_rate=args.failure_rate, mlsd=not args.no_mlsd)
+    server.start()
+
+    print(f'{args.protocol.upper()}, {args.files} files of {args.size} bytes, {args.latency * 1000:.0f}ms latency, '
+          f'{"unlimited" if args.bandwidth is None else str(args.bandwidth) + " B/s"} per connection, '
+          f'{args.failure_rate:.0%} failures')
+    print(f'{"connections":>11} {"seconds":>8} {"files/s":>8} {"MB/s":>8} {"setup p50":>10} {"1st byte p50":>13} '
+          f'{"idle":>6} {"errors":>6}')
+
+    try:
+        for connections in (int(x) for x in args.connections.split(',')):
+            report = run(server, connections, args.verbose)
+            transfers = report['transfers']
+            workers = report['workers']
+            elapsed = report['elapsed']
+            busy = workers['transferring'] + workers['idle']
+            print(f'{connections:>11} {elapsed:>8.2f} {transfers["count"] / elapsed:>8.1f} '
+                  f'{transfers["bytes"] / elapsed / (1024 * 1024):>8.2f} '
+                  f'{(transfers["setup"] or {}).get("p50", 0) * 1000:>8.1f}ms '
+                  f'{(transfers["first_byte"] or {}).get("p50", 0) * 1000:>11.1f}ms '
+                  f'{workers["idle"] / busy if busy > 0 else 0:>6.0%} {transfers["failed"]:>6}')
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
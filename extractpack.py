@@ -0,0 +1,172 @@
+"""
+Packs the tree unar extracts an archive into as a single file, so extracted archives are kept as one file each instead
+of a folder of small files and AppleDouble sidecars, and can be read back with a single open.
+
+Layout:
+    header   magic, format version, compression, then the offset and length of the index (see HEADER)
+    forks    data and resource forks back to back, each compressed on its own when compression is on
+    index    JSON object {"source": key, "entries": [...]}, where key identifies the archive the pack was extracted from
+             (see preparecache.input_key() and data_key()), and entries are in the order os.walk found them:
+             {"dir": path} for a directory
+             {"file": path, "data": span, "rsrc": span, "finder": [type, creator, flags, x, y], "double": bool}
+             for a file. Spans are [offset, stored length, length] of a fork, or null if there is none. "double" tells
+             whether the file had an AppleDouble sidecar that could be parsed, which rsrc and finder come from. Paths
+             are relative to the extracted folder, separated by '/'.
+
+A file's .rsrc sidecar is merged into its entry. A .rsrc file without a data file gets an entry of its own, with no data
+fork, just like preparevolume.add_file() treats it.
+"""
+
+import json
+import lzma
+import mmap
+import os
+import struct
+from typing import List, Optional
+
+import appledouble
+
+PACK_SUFFIX = '.pack'
+PARTIAL_SUFFIX = '.part'
+
+MAGIC = b'MPPK'
+VERSION = 2
+COMPRESSION_NONE = 0
+COMPRESSION_LZMA = 1
+
+# Magic, version, compression, index offset and index length.
+HEADER = struct.Struct('>4sBBxxQQ')
+
+# [offset, stored length, length], relative to the start of the file.
+Span = Optional[List[int]]
+
+
+class InvalidPack(Exception):
+    pass
+
+
+def parse_sidecar(rsrc_path: str) -> Optional[appledouble.AppleDouble]:
+    if not os.path.isfile(rsrc_path):
+        return None
+    with open(rsrc_path, 'rb') as f:
+        try:
+            return appledouble.parse(f)
+        except ValueError:
+            return None
+
+
+class PackWriter(object):
+    def __init__(self, f, compress: bool):
+        self.f = f
+        self.compress = compress
+        self.f.write(bytes(HEADER.size))
+
+    def add_fork(self, data: bytes) -> Span:
+        stored = lzma.compress(data) if self.compress else data
+        offset = self.f.tell()
+        self.f.write(stored)
+        return [offset, len(stored), len(data)]
+
+    def file_entry(self, relative_path: str, data_path: Optional[str], rsrc_path: str) -> dict:
+        entry = {'file': relative_path, 'data': None, 'rsrc': None, 'finder': None, 'double': False}
+        if data_path is not None:
+            with open(data_path, 'rb') as f:
+                entry['data'] = self.add_fork(f.read())
+
+        double = parse_sidecar(rsrc_path)
+        if double:
+            entry['double'] = True
+            rsrc_entry = double.get_entry(appledouble.EntryType.resource_fork)
+            if rsrc_entry:
+                entry['rsrc'] = self.add_fork(rsrc_entry.data)
+            finder_entry = double.get_entry(appledouble.EntryType.finder_info)
+            if finder_entry:
+                info = finder_entry.data
+                entry['finder'] = [bytes(info.fdType).hex(), bytes(info.fdCreator).hex(), info.fdFlags,
+                                   info.fdLocation.x, info.fdLocation.y]
+        return entry
+
+    def finish(self, entries: List[dict], source: str):
+        index = json.dumps({'source': source, 'entries': entries}).encode()
+        index_offset = self.f.tell()
+        self.f.write(index)
+        self.f.seek(0)
+        compression = COMPRESSION_LZMA if self.compress else COMPRESSION_NONE
+        self.f.write(HEADER.pack(MAGIC, VERSION, compression, index_offset, len(index)))
+
+
+def write_pack(directory: str, pack_path: str, compress: bool = False, source: str = ''):
+    """
+    Pack the tree at directory into pack_path, replacing it at once when done so a pack is never left half written.
+    :param compress: Compress each fork with lzma.
+    :param source: Key of the archive the tree was extracted from, to tell later whether the pack is still current.
+    """
+    entries = []
+    partial_path = pack_path + PARTIAL_SUFFIX
+    with open(partial_path, 'wb') as f:
+        writer = PackWriter(f, compress)
+        for dirpath, dirnames, filenames in os.walk(directory):
+            relative_dir = os.path.relpath(dirpath, directory)
+            prefix = '' if relative_dir == '.' else relative_dir.replace(os.sep, '/') + '/'
+
+            for dirname in dirnames:
+                entries.append({'dir': prefix + dirname})
+
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                base_filename, ext = os.path.splitext(filename)
+                if ext == '.rsrc':
+                    if os.path.isfile(os.path.join(dirpath, base_filename)):
+                        # Merged into the entry of its data file.
+                        continue
+                    entries.append(writer.file_entry(prefix + filename, None, filepath))
+                else:
+                    entries.append(writer.file_entry(prefix + filename, filepath, filepath + '.rsrc'))
+
+        writer.finish(entries, source)
+        # On disk before it takes the final name, so a crash can't leave an empty pack under it.
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial_path, pack_path)
+
+
+class Pack(object):
+    """A pack opened for reading, mapped into memory."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            # Left empty or cut short by a crash or a full disk, and an empty file can't be mapped.
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise InvalidPack(f'{path} is too short to be a pack')
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, self.compression, index_offset, index_length = HEADER.unpack_from(self.map)
+            if magic != MAGIC or version != VERSION:
+                raise InvalidPack(f'{path} is not a version {VERSION} pack')
+            try:
+                index = json.loads(self.map[index_offset:index_offset + index_length])
+                self.source: str = index['source']
+                self.entries: List[dict] = index['entries']
+            except (ValueError, KeyError, TypeError) as e:
+                raise InvalidPack(f'{path} has a broken index') from e
+        except Exception:
+            self.map.close()
+            raise
+
+    def read(self, span: Span) -> bytes:
+        offset, stored_length, _ = span
+        stored = self.map[offset:offset + stored_length]
+        if self.compression == COMPRESSION_LZMA:
+            return lzma.decompress(stored)
+        return stored
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
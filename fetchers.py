@@ -0,0 +1,613 @@
+"""
+Backends macftp.py can list and download files from. The scheduling (worker connections, retries, rate limits) is the
+same for all of them and lives in macftp.py; a backend only knows how to open a session and, over that session, list a
+directory and stream a file from an offset.
+
+Every backend names files by their path relative to its base, e.g. 'Garden/apps/Foo.sit', so a mirror with the same
+layout as the FTP server shares the download directory and listing database with it.
+
+Listings are (size, path, modify) tuples, where modify is the modification time as YYYYMMDDHHMMSS (UTC), or None when
+the backend can't tell.
+
+retrieve() streams a file from an offset, optionally stopping after length bytes so several sessions can each fetch one
+range of the same file. Stopping early can leave a session unfit for another transfer, so a session that has retrieved
+a range with a length should only be ended afterwards.
+"""
+
+import email.utils
+import ftplib
+import html.parser
+import http.client
+import os
+import posixpath
+import random
+import threading
+import time
+import urllib.parse
+from typing import List, Optional, Tuple
+
+Row = Tuple[int, str, Optional[str]]
+
+HTTP_TIMEOUT = 60  # Seconds
+HTTP_BLOCK_SIZE = 64 * 1024
+LOCAL_BLOCK_SIZE = 1024 * 1024
+
+# Replies to MLSD from servers that don't know the command: syntax error and not implemented.
+MLSD_UNSUPPORTED_REPLIES = ('500', '502')
+
+
+class PermanentError(Exception):
+    """A file or directory that can't be fetched however often it is retried, e.g. because it doesn't exist."""
+    pass
+
+
+class FTPSession(object):
+    def __init__(self, backend: 'FTPBackend', ftp: ftplib.FTP):
+        self.backend = backend
+        self.ftp = ftp
+
+    def list_directory(self, path: str) -> Tuple[List[Row], List[str]]:
+        """
+        List a directory, using MLSD facts when the server supports them.
+        :return: The files in the directory, and the paths of its subdirectories.
+        """
+        if self.backend.mlsd_supported:
+            try:
+                entries = list(self.ftp.mlsd(path, facts=['type', 'size', 'modify']))
+            except ftplib.error_perm as e:
+                if not str(e).startswith(MLSD_UNSUPPORTED_REPLIES):
+                    # e.g. 550, the directory is missing or unreadable, which LIST wouldn't change.
+                    raise PermanentError(str(e)) from e
+                print('Server does not support MLSD, falling back to LIST')
+                self.backend.mlsd_supported = False
+            else:
+                files = [(int(facts['size']), posixpath.join(path, name), facts.get('modify'))
+                         for name, facts in entries if facts.get('type') == 'file']
+                directories = [posixpath.join(path, name) for name, facts in entries if facts.get('type') == 'dir']
+                return files, directories
+
+        files = []
+        directories = []
+
+        def callback(line):
+            parts = line.split(None, 8)
+            if len(parts) < 9:
+                return  # e.g. the "total" line
+            if parts[0].startswith('d'):
+                if parts[8] not in ('.', '..'):
+                    directories.append(posixpath.join(path, parts[8]))
+            else:
+                files.append((int(parts[4]), posixpath.join(path, parts[8]), None))
+
+        try:
+            self.ftp.retrlines('LIST ' + path, callback=callback)
+        except ftplib.error_perm as e:
+            raise PermanentError(str(e)) from e
+        return files, directories
+
+    def retrieve(self, path: str, callback, offset: int = 0, length: Optional[int] = None, blocksize: int = 8192):
+        """
+        Like ftplib.FTP.retrbinary, but also times the transfer.
+        :return: The server's final reply, and the seconds from sending RETR until the data connection was open, until
+        the first data arrived (None if there was none), and until the transfer completed.
+        """
+        remaining = length
+        try:
+            self.ftp.voidcmd('TYPE I')
+            start = time.monotonic()
+            first_byte = None
+            with self.ftp.transfercmd('RETR ' + path, offset if offset > 0 else None) as conn:
+                setup = time.monotonic() - start
+                while remaining is None or remaining > 0:
+                    data = conn.recv(blocksize if remaining is None else min(blocksize, remaining))
+                    if not data:
+                        break
+                    if first_byte is None:
+                        first_byte = time.monotonic() - start
+                    callback(data)
+                    if remaining is not None:
+                        remaining -= len(data)
+
+            if remaining == 0:
+                # The data connection was closed once the range was complete, possibly before the server was done
+                # sending, in which case it reports the transfer as aborted.
+                try:
+                    result = self.ftp.voidresp()
+                except ftplib.error_temp as e:
+                    result = str(e)
+            else:
+                result = self.ftp.voidresp()
+        except ftplib.error_perm as e:
+            raise PermanentError(str(e)) from e
+        return result, setup, first_byte, time.monotonic() - start
+
+    def close(self):
+        self.ftp.close()
+
+    def quit(self):
+        """Politely end the session, without failing if the control connection has already died."""
+        try:
+            self.ftp.quit()
+        except ftplib.all_errors:
+            self.ftp.close()
+
+
+class FTPBackend(object):
+    # Connection and transfer errors worth retrying over a new session.
+    errors = ftplib.all_errors
+
+    def __init__(self, host: str, port: int = 21, user: str = 'anonymous', password: str = '', base: str = '',
+                 timeout: Optional[float] = None):
+        """:param timeout: Seconds without any progress before a connection or transfer fails, None to wait forever."""
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.base = base
+        self.timeout = timeout
+
+        # Set to False once the server has rejected MLSD, so later listings go straight to LIST.
+        self.mlsd_supported = True
+
+    def __str__(self):
+        return f'ftp://{self.host}:{self.port}/{self.base}'
+
+    def connect(self) -> FTPSession:
+        print('Connecting to FTP...')
+        ftp = ftplib.FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.user, self.password)
+        if self.base:
+            ftp.cwd(self.base)
+        return FTPSession(self, ftp)
+
+
+class LinkParser(html.parser.HTMLParser):
+    """Collects the targets of all links on a page."""
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.links.append(href)
+
+
+def http_date_to_modify(value: Optional[str]) -> Optional[str]:
+    if value is None:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).strftime('%Y%m%d%H%M%S')
+    except (TypeError, ValueError):
+        return None
+
+
+class HTTPStatusError(http.client.HTTPException):
+    pass
+
+
+class HTTPSession(object):
+    """
+    One persistent (keep-alive) connection to the mirror. Directories are listed from their index pages, like Apache's
+    or nginx's autoindex, with a HEAD request for the size and modification time of each file.
+    """
+
+    def __init__(self, backend: 'HTTPBackend', connection: http.client.HTTPConnection):
+        self.backend = backend
+        self.connection = connection
+
+    def request(self, method: str, path: str, headers: Optional[dict] = None) -> http.client.HTTPResponse:
+        self.connection.request(method, self.backend.url_path(path), headers=headers or {})
+        response = self.connection.getresponse()
+        if response.status >= 400:
+            response.read()
+            if response.status in (403, 404, 410):
+                raise PermanentError(f'{response.status} {response.reason}: {path}')
+            raise HTTPStatusError(f'{response.status} {response.reason}: {path}')
+        return response
+
+    def list_directory(self, path: str) -> Tuple[List[Row], List[str]]:
+        directory = path.rstrip('/') + '/' if path else ''
+        response = self.request('GET', directory)
+        parser = LinkParser()
+        parser.feed(response.read().decode('utf-8', errors='replace'))
+        parser.close()
+
+        directory_url_path = self.backend.url_path(directory)
+        prefix = urllib.parse.unquote(directory_url_path)
+        names = set()
+        for href in parser.links:
+            target = urllib.parse.urlsplit(urllib.parse.urljoin(directory_url_path, href))
+            target_path = urllib.parse.unquote(target.path)
+            # Skip sorting links, parent directories and anything on another host.
+            if target.query or target.netloc or not target_path.startswith(prefix):
+                continue
+            name = target_path[len(prefix):]
+            if name and '/' not in name.rstrip('/'):
+                names.add(name)
+
+        files = []
+        directories = []
+        for name in sorted(names):
+            if name.endswith('/'):
+                directories.append(posixpath.join(path, name.rstrip('/')))
+                continue
+            file_path = posixpath.join(path, name)
+            response = self.request('HEAD', file_path)
+            response.read()
+            length = response.getheader('Content-Length')
+            if length is None:
+                print(f'No size for {file_path}, skipping')
+                continue
+            files.append((int(length), file_path, http_date_to_modify(response.getheader('Last-Modified'))))
+        return files, directories
+
+    def retrieve(self, path: str, callback, offset: int = 0, length: Optional[int] = None):
+        """:return: The status line, and the seconds until the response headers, the first data and the end arrived."""
+        headers = None
+        if length is not None:
+            headers = {'Range': f'bytes={offset}-{offset + length - 1}'}
+        elif offset > 0:
+            headers = {'Range': f'bytes={offset}-'}
+
+        start = time.monotonic()
+        response = self.request('GET', path, headers)
+        setup = time.monotonic() - start
+
+        # A server that ignores the range sends the whole file, so skip the part that is already here and stop reading
+        # at the end of the range.
+        skip = offset if offset > 0 and response.status != 206 else 0
+        remaining = length
+        first_byte = None
+        while remaining is None or remaining > 0:
+            data = response.read(HTTP_BLOCK_SIZE)
+            if not data:
+                break
+            if skip > 0:
+                dropped = min(skip, len(data))
+                data = data[dropped:]
+                skip -= dropped
+                if not data:
+                    continue
+            if remaining is not None:
+                data = data[:remaining]
+                remaining -= len(data)
+            if first_byte is None:
+                first_byte = time.monotonic() - start
+            callback(data)
+
+        if not response.isclosed():
+            # The rest of the response was not read, so the connection can't be reused.
+            self.connection.close()
+        return f'{response.status} {response.reason}', setup, first_byte, time.monotonic() - start
+
+    def close(self):
+        self.connection.close()
+
+    def quit(self):
+        self.connection.close()
+
+
+class HTTPBackend(object):
+    errors = (OSError, http.client.HTTPException)
+
+    def __init__(self, url: str, timeout: float = HTTP_TIMEOUT):
+        """:param url: Base URL of the mirror, e.g. https://mirror.example.org/garden/"""
+        self.timeout = timeout
+        parts = urllib.parse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base = parts.path.rstrip('/') + '/'
+
+    def __str__(self):
+        return f'{self.scheme}://{self.host}{"" if self.port is None else ":" + str(self.port)}{self.base}'
+
+    def url_path(self, path: str) -> str:
+        return self.base + urllib.parse.quote(path)
+
+    def connect(self) -> HTTPSession:
+        print(f'Connecting to {self.host}...')
+        if self.scheme == 'https':
+            connection = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        connection.connect()
+        return HTTPSession(self, connection)
+
+
+class LocalSession(object):
+    """Copies from a directory, e.g. a NAS mount holding a copy of the server."""
+
+    def __init__(self, backend: 'LocalBackend'):
+        self.backend = backend
+
+    def list_directory(self, path: str) -> Tuple[List[Row], List[str]]:
+        try:
+            entries = list(os.scandir(os.path.join(self.backend.root, path)))
+        except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
+            raise PermanentError(str(e)) from e
+
+        files = []
+        directories = []
+        for entry in entries:
+            if entry.is_dir():
+                directories.append(posixpath.join(path, entry.name))
+            elif entry.is_file():
+                stat = entry.stat()
+                modify = time.strftime('%Y%m%d%H%M%S', time.gmtime(stat.st_mtime))
+                files.append((stat.st_size, posixpath.join(path, entry.name), modify))
+        return files, directories
+
+    def retrieve(self, path: str, callback, offset: int = 0, length: Optional[int] = None):
+        start = time.monotonic()
+        try:
+            f = open(os.path.join(self.backend.root, path), 'rb')
+        except (FileNotFoundError, IsADirectoryError, PermissionError) as e:
+            raise PermanentError(str(e)) from e
+
+        with f:
+            f.seek(offset)
+            setup = time.monotonic() - start
+            first_byte = None
+            remaining = length
+            while remaining is None or remaining > 0:
+                data = f.read(LOCAL_BLOCK_SIZE if remaining is None else min(LOCAL_BLOCK_SIZE, remaining))
+                if not data:
+                    break
+                if first_byte is None:
+                    first_byte = time.monotonic() - start
+                callback(data)
+                if remaining is not None:
+                    remaining -= len(data)
+        return 'copied', setup, first_byte, time.monotonic() - start
+
+    def close(self):
+        pass
+
+    def quit(self):
+        pass
+
+
+class LocalBackend(object):
+    errors = (OSError,)
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def __str__(self):
+        return self.root
+
+    def connect(self) -> LocalSession:
+        if not os.path.isdir(self.root):
+            raise FileNotFoundError(f'{self.root} is not a directory')
+        return LocalSession(self)
+
+
+class Mirror(object):
+    """A backend in a MirrorSet, with what has been measured about it."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.sessions = 0
+
+        # Decaying sums of transferred bytes and the seconds they took, see MIRROR_DECAY.
+        self.bytes = 0.0
+        self.seconds = 0.0
+        self.latency: Optional[float] = None
+
+        self.transfers = 0
+        self.total_bytes = 0
+        self.errors = 0
+        self.failures = 0  # Consecutive
+        self.down_until = 0.0
+
+    @property
+    def speed(self) -> Optional[float]:
+        """Recent bytes per second of one connection, None until something has been downloaded."""
+        return self.bytes / self.seconds if self.seconds > 0 else None
+
+    def report(self) -> dict:
+        return {
+            'source': str(self.backend),
+            'transfers': self.transfers,
+            'bytes': self.total_bytes,
+            'speed': self.speed,
+            'latency': self.latency,
+            'errors': self.errors,
+        }
+
+
+# Weight of earlier measurements each time a mirror's speed is updated, so the speed follows the mirror's current
+# state.
+MIRROR_DECAY = 0.8
+# How much better balanced the mirrors have to be before a connection moves, so measurement noise doesn't make
+# connections hop back and forth.
+MIRROR_HYSTERESIS = 1.25
+MIRROR_RETRY_DELAY = 2.0  # Seconds a failed mirror is avoided for, doubled after every consecutive failure.
+MAX_MIRROR_RETRY_DELAY = 120.0
+
+
+class MirrorSession(object):
+    """A session on one mirror of a MirrorSet, measuring every transfer."""
+
+    def __init__(self, mirror_set: 'MirrorSet', mirror: Mirror, session):
+        self.mirror_set = mirror_set
+        self.mirror = mirror
+        self.session = session
+        self.closed = False
+
+    def on_other_mirror(self, path: str, error: PermanentError, method: str, *args):
+        """Call method on a session with a mirror that might still have path, as it is missing from this one."""
+        mirror = self.mirror_set.alternative(self.mirror, path)
+        if mirror is None:
+            raise error
+        print(f'{path} is missing from {self.mirror.backend}, trying {mirror.backend}')
+        session = self.mirror_set.connect(mirror)
+        try:
+            return getattr(session, method)(path, *args)
+        finally:
+            session.quit()
+
+    def list_directory(self, path: str) -> Tuple[List[Row], List[str]]:
+        try:
+            return self.session.list_directory(path)
+        except PermanentError as e:
+            return self.on_other_mirror(path, e, 'list_directory')
+        except self.mirror.backend.errors:
+            self.mirror_set.failed(self.mirror)
+            raise
+
+    def retrieve(self, path: str, callback, offset: int = 0, length: Optional[int] = None):
+        byte_count = 0
+
+        def counting_callback(data):
+            nonlocal byte_count
+            byte_count += len(data)
+            callback(data)
+
+        try:
+            result, setup, first_byte, duration = self.session.retrieve(path, counting_callback, offset, length)
+        except PermanentError as e:
+            return self.on_other_mirror(path, e, 'retrieve', callback, offset, length)
+        except self.mirror.backend.errors:
+            self.mirror_set.failed(self.mirror)
+            raise
+
+        self.mirror_set.succeeded(self.mirror, byte_count, setup, duration)
+        return result, setup, first_byte, duration
+
+    def release(self):
+        if not self.closed:
+            self.closed = True
+            self.mirror_set.released(self.mirror)
+
+    def close(self):
+        self.session.close()
+        self.release()
+
+    def quit(self):
+        self.session.quit()
+        self.release()
+
+
+class MirrorSet(object):
+    """
+    Several mirrors with the same layout, used as one backend.
+
+    Every connection goes to one mirror. New connections go where they are needed most for the number of connections
+    on each mirror to be in proportion to its measured speed, and download_worker moves a connection whenever
+    should_move() says the balance is off. A mirror that fails or stalls (see the backends' timeouts) is avoided for a
+    while, so connections fail over to the others, and a file missing from one mirror is fetched from another.
+    """
+
+    def __init__(self, backends):
+        self.mirrors = [Mirror(backend) for backend in backends]
+        self.errors = tuple(set(error for backend in backends for error in backend.errors))
+        self.lock = threading.Lock()
+        # Mirrors each path was found missing from.
+        self.missing_from = {}
+
+    def __str__(self):
+        return f'{len(self.mirrors)} mirrors'
+
+    def weight(self, mirror: Mirror) -> float:
+        """Caller must hold the lock. Mirrors that haven't been measured yet are assumed to be average."""
+        speeds = [m.speed for m in self.mirrors if m.speed is not None]
+        if mirror.speed is not None:
+            return mirror.speed
+        return sum(speeds) / len(speeds) if speeds else 1.0
+
+    def up(self) -> List[Mirror]:
+        """Caller must hold the lock. :return: The mirrors that aren't being avoided, or the one that recovers first."""
+        now = time.monotonic()
+        mirrors = [m for m in self.mirrors if m.down_until <= now]
+        return mirrors or [min(self.mirrors, key=lambda m: m.down_until)]
+
+    def connect(self, mirror: Optional[Mirror] = None) -> MirrorSession:
+        with self.lock:
+            if mirror is None:
+                # The mirror with the fewest connections for its speed, breaking ties at random.
+                candidates = self.up()
+                random.shuffle(candidates)
+                mirror = min(candidates, key=lambda m: (m.sessions + 1) / self.weight(m))
+            mirror.sessions += 1
+
+        try:
+            session = mirror.backend.connect()
+        except mirror.backend.errors:
+            with self.lock:
+                mirror.sessions -= 1
+            self.failed(mirror)
+            raise
+        return MirrorSession(self, mirror, session)
+
+    def should_move(self, session: MirrorSession) -> bool:
+        """:return: Whether the connection would be better used on another mirror."""
+        with self.lock:
+            mirror = session.mirror
+            if mirror not in self.up():
+                return True
+            load = mirror.sessions / self.weight(mirror)
+            return any(load > (m.sessions + 1) / self.weight(m) * MIRROR_HYSTERESIS
+                       for m in self.up() if m is not mirror)
+
+    def succeeded(self, mirror: Mirror, byte_count: int, setup: float, duration: float):
+        with self.lock:
+            mirror.transfers += 1
+            mirror.total_bytes += byte_count
+            mirror.failures = 0
+            mirror.bytes = mirror.bytes * MIRROR_DECAY + byte_count
+            mirror.seconds = mirror.seconds * MIRROR_DECAY + duration
+            mirror.latency = setup if mirror.latency is None else mirror.latency * MIRROR_DECAY + setup * (1 - MIRROR_DECAY)
+
+    def failed(self, mirror: Mirror):
+        with self.lock:
+            mirror.errors += 1
+            mirror.failures += 1
+            delay = min(MAX_MIRROR_RETRY_DELAY, MIRROR_RETRY_DELAY * 2 ** (mirror.failures - 1))
+            mirror.down_until = time.monotonic() + delay
+        print(f'Avoiding {mirror.backend} for {delay:.0f}s after an error')
+
+    def alternative(self, mirror: Mirror, path: str) -> Optional[Mirror]:
+        """
+        Record that path is missing from mirror.
+        :return: The fastest mirror that path hasn't been found missing from yet, None if it is missing from all of them.
+        """
+        with self.lock:
+            missing_from = self.missing_from.setdefault(path, set())
+            missing_from.add(mirror)
+            candidates = [m for m in self.up() if m not in missing_from] or \
+                         [m for m in self.mirrors if m not in missing_from]
+            return max(candidates, key=self.weight) if candidates else None
+
+    def released(self, mirror: Mirror):
+        with self.lock:
+            mirror.sessions -= 1
+
+    def report(self) -> List[dict]:
+        with self.lock:
+            return [mirror.report() for mirror in self.mirrors]
+
+
+def open_backend(source: str, timeout: Optional[float] = None):
+    """
+    :param source: ftp://[user[:password]@]host[:port][/base], http(s)://host[:port]/base/, file:///path or a local
+    directory path.
+    :param timeout: Seconds without progress before a network transfer fails.
+    """
+    parts = urllib.parse.urlsplit(source)
+    if parts.scheme == 'ftp':
+        return FTPBackend(parts.hostname, parts.port or 21, urllib.parse.unquote(parts.username or 'anonymous'),
+                          urllib.parse.unquote(parts.password or ''), urllib.parse.unquote(parts.path.lstrip('/')),
+                          timeout)
+    if parts.scheme in ('http', 'https'):
+        return HTTPBackend(source, HTTP_TIMEOUT if timeout is None else timeout)
+    if parts.scheme == 'file':
+        return LocalBackend(urllib.parse.unquote(parts.path))
+    if parts.scheme == '' or os.path.isdir(source):
+        return LocalBackend(source)
+    raise ValueError(f'Unsupported source {source}')
@@ -0,0 +1,417 @@
+"""
+A small in-process FTP server standing in for the macintoshgarden server, so macftp.py can be exercised and
+benchmarked locally.
+
+It serves a synthetic read-only tree and only speaks the subset of FTP that ftplib and macftp.py use (USER, PASS, PWD,
+CWD, TYPE, OPTS, PASV, EPSV, REST, RETR, SIZE, LIST, MLSD, NOOP and QUIT). Latency, bandwidth and failures can be
+injected to mimic a slow or flaky link.
+
+HTTPStandIn serves the same kind of tree as an HTTP mirror, with autoindex-style directory pages and Range requests,
+for macftp.py's --source http://...
+"""
+
+import html
+import http.server
+import posixpath
+import random
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+import zlib
+from typing import Dict, Optional
+
+# Contents of synthetic files repeat this pattern, starting at an offset derived from the file's path.
+PATTERN_SIZE = 64 * 1024
+SEND_BLOCK_SIZE = 16 * 1024
+
+
+class SyntheticTree(object):
+    """A tree of files that only exist as sizes. Contents are generated on demand, and the same every time."""
+
+    def __init__(self, files: Dict[str, int], modify: str = '20200101000000', seed: int = 0):
+        """
+        :param files: Sizes of files by path, e.g. {'Garden/apps/Foo.sit': 1234}. Parent directories are implied.
+        :param modify: MLSD modify fact reported for every file.
+        """
+        self.files = dict(files)
+        self.modify = modify
+        self.pattern = random.Random(seed).randbytes(PATTERN_SIZE) * 2
+        self.overrides: Dict[str, bytes] = {}
+
+        self.directories = {''}
+        for path in self.files:
+            parent = posixpath.dirname(path)
+            while parent not in self.directories:
+                self.directories.add(parent)
+                parent = posixpath.dirname(parent)
+
+    def set_contents(self, path: str, data: bytes):
+        """Serve data for path instead of the generated pattern."""
+        self.files[path] = len(data)
+        self.overrides[path] = data
+
+    def read(self, path: str, offset: int, length: int) -> bytes:
+        length = max(0, min(length, self.files[path] - offset))
+        if path in self.overrides:
+            return self.overrides[path][offset:offset + length]
+
+        start = zlib.crc32(path.encode('utf-8')) % PATTERN_SIZE
+        chunks = []
+        while length > 0:
+            position = (start + offset) % PATTERN_SIZE
+            chunk = self.pattern[position:position + min(length, PATTERN_SIZE)]
+            chunks.append(chunk)
+            offset += len(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+
+    def contents(self, path: str) -> bytes:
+        return self.read(path, 0, self.files[path])
+
+    def list(self, directory: str):
+        """:return: (name, is_directory, size) of each entry in directory."""
+        entries = []
+        for path in self.directories:
+            if path and posixpath.dirname(path) == directory:
+                entries.append((posixpath.basename(path), True, 0))
+        for path, size in self.files.items():
+            if posixpath.dirname(path) == directory:
+                entries.append((posixpath.basename(path), False, size))
+        return sorted(entries)
+
+
+class FTPStandInHandler(socketserver.StreamRequestHandler):
+    server: 'FTPStandIn'
+
+    def setup(self):
+        super().setup()
+        self.cwd = ''
+        self.rest = 0
+        self.passive: Optional[socket.socket] = None
+
+    def reply(self, code: int, text: str):
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        self.wfile.write(f'{code} {text}\r\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def resolve(self, path: str) -> str:
+        path = posixpath.normpath(posixpath.join('/', self.cwd, path)).lstrip('/')
+        return '' if path == '.' else path
+
+    def handle(self):
+        if self.server.should_fail():
+            self.reply(421, 'Too many connections (injected failure)')
+            return
+        self.reply(220, 'FTP stand-in ready')
+
+        for raw_line in self.rfile:
+            line = raw_line.decode('utf-8', errors='replace').rstrip('\r\n')
+            command, _, argument = line.partition(' ')
+            command = command.upper()
+
+            handler = getattr(self, 'ftp_' + command.lower(), None)
+            if handler is None:
+                self.reply(502, f'{command} not implemented')
+                continue
+            if handler(argument) is False:
+                break
+
+        if self.passive is not None:
+            self.passive.close()
+
+    def ftp_user(self, argument):
+        self.reply(331, 'Password required')
+
+    def ftp_pass(self, argument):
+        self.reply(230, 'Logged in')
+
+    def ftp_quit(self, argument):
+        self.reply(221, 'Bye')
+        return False
+
+    def ftp_noop(self, argument):
+        self.reply(200, 'OK')
+
+    def ftp_type(self, argument):
+        self.reply(200, f'Type set to {argument}')
+
+    def ftp_opts(self, argument):
+        # e.g. OPTS MLST type;size;modify; which ftplib sends before MLSD. Every fact is always sent anyway.
+        self.reply(200, 'OK')
+
+    def ftp_pwd(self, argument):
+        self.reply(257, f'"/{self.cwd}" is the current directory')
+
+    def ftp_cwd(self, argument):
+        path = self.resolve(argument)
+        if path not in self.server.tree.directories:
+            self.reply(550, f'{argument}: No such directory')
+            return
+        self.cwd = path
+        self.reply(250, f'Changed to /{path}')
+
+    def ftp_size(self, argument):
+        path = self.resolve(argument)
+        if path not in self.server.tree.files:
+            self.reply(550, f'{argument}: No such file')
+            return
+        self.reply(213, str(self.server.tree.files[path]))
+
+    def ftp_rest(self, argument):
+        self.rest = int(argument)
+        self.reply(350, f'Restarting at {self.rest}')
+
+    def open_passive(self) -> int:
+        if self.passive is not None:
+            self.passive.close()
+        self.passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.passive.bind((self.server.server_address[0], 0))
+        self.passive.listen(1)
+        self.passive.settimeout(10)
+        return self.passive.getsockname()[1]
+
+    def ftp_pasv(self, argument):
+        port = self.open_passive()
+        host = self.server.server_address[0].replace('.', ',')
+        self.reply(227, f'Entering Passive Mode ({host},{port >> 8},{port & 0xFF})')
+
+    def ftp_epsv(self, argument):
+        port = self.open_passive()
+        self.reply(229, f'Entering Extended Passive Mode (|||{port}|)')
+
+    def accept_data(self) -> Optional[socket.socket]:
+        if self.passive is None:
+            self.reply(425, 'Use PASV or EPSV first')
+            return None
+        try:
+            connection, _ = self.passive.accept()
+        finally:
+            self.passive.close()
+            self.passive = None
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        return connection
+
+    def send_listing(self, lines):
+        self.reply(150, 'Here comes the listing')
+        connection = self.accept_data()
+        if connection is None:
+            return
+        with connection:
+            connection.sendall(''.join(line + '\r\n' for line in lines).encode('utf-8'))
+        self.reply(226, 'Transfer complete')
+
+    def ftp_list(self, argument):
+        directory = self.resolve(argument)
+        if directory not in self.server.tree.directories:
+            self.reply(550, f'{argument}: No such directory')
+            return
+        lines = [f'total {len(self.server.tree.list(directory))}']
+        for name, is_directory, size in self.server.tree.list(directory):
+            mode = 'drwxr-xr-x' if is_directory else '-rw-r--r--'
+            lines.append(f'{mode}    1 ftp      ftp      {size:>10} Jan 01  2020 {name}')
+        self.send_listing(lines)
+
+    def ftp_mlsd(self, argument):
+        if not self.server.mlsd:
+            self.reply(500, 'MLSD not understood')
+            return
+        directory = self.resolve(argument)
+        if directory not in self.server.tree.directories:
+            self.reply(550, f'{argument}: No such directory')
+            return
+        lines = []
+        for name, is_directory, size in self.server.tree.list(directory):
+            if is_directory:
+                lines.append(f'type=dir;modify={self.server.tree.modify}; {name}')
+            else:
+                lines.append(f'type=file;size={size};modify={self.server.tree.modify}; {name}')
+        self.send_listing(lines)
+
+    def ftp_retr(self, argument):
+        path = self.resolve(argument)
+        offset, self.rest = self.rest, 0
+        if path not in self.server.tree.files:
+            self.reply(550, f'{argument}: No such file')
+            return
+
+        self.reply(150, f'Opening BINARY mode data connection for {argument}')
+        connection = self.accept_data()
+        if connection is None:
+            return
+
+        size = self.server.tree.files[path]
+        # An injected failure drops the data connection somewhere in the middle of the file.
+        fail_at = random.randint(offset, size) if self.server.should_fail() else None
+        start = time.monotonic()
+        sent = 0
+        closed_by_client = False
+        with connection:
+            while offset < size:
+                length = SEND_BLOCK_SIZE
+                if fail_at is not None:
+                    length = min(length, fail_at - offset)
+                    if length <= 0:
+                        break
+                block = self.server.tree.read(path, offset, length)
+                try:
+                    connection.sendall(block)
+                except OSError:
+                    # e.g. a client that only wanted part of the file.
+                    closed_by_client = True
+                    break
+                offset += len(block)
+                sent += len(block)
+
+                if self.server.bandwidth is not None:
+                    ahead = sent / self.server.bandwidth - (time.monotonic() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        if closed_by_client:
+            self.reply(426, 'Connection closed; transfer aborted')
+        elif fail_at is not None:
+            self.reply(426, 'Connection closed; transfer aborted (injected failure)')
+        else:
+            self.reply(226, 'Transfer complete')
+
+
+class HTTPStandInHandler(http.server.BaseHTTPRequestHandler):
+    server: 'HTTPStandIn'
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.first_request = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_status(self, code: int, length: int = 0, headers: Optional[Dict[str, str]] = None):
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        self.send_response(code)
+        self.send_header('Content-Length', str(length))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def handle_request(self, send_body: bool):
+        # Like the FTP stand-in, refuse some new connections rather than individual requests.
+        first_request, self.first_request = self.first_request, False
+        if first_request and self.server.should_fail():
+            self.send_status(503)
+            return
+
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).strip('/')
+        tree = self.server.tree
+
+        if path in tree.directories:
+            links = []
+            for name, is_directory, size in tree.list(path):
+                href = urllib.parse.quote(name) + ('/' if is_directory else '')
+                links.append(f'<a href="{html.escape(href)}">{html.escape(name)}</a>')
+            body = ('<html><body><a href="../">../</a>\n' + '\n'.join(links) + '\n</body></html>').encode('utf-8')
+            self.send_status(200, len(body), {'Content-Type': 'text/html'})
+            if send_body:
+                self.wfile.write(body)
+            return
+
+        if path not in tree.files:
+            self.send_status(404)
+            return
+
+        size = tree.files[path]
+        offset = 0
+        end = size
+        headers = {'Last-Modified': time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.strptime(tree.modify, '%Y%m%d%H%M%S'))}
+        code = 200
+        ranges = self.headers.get('Range')
+        if ranges is not None and ranges.startswith('bytes=') and ',' not in ranges:
+            # Only a single range, e.g. bytes=100- or bytes=100-199.
+            first, _, last = ranges[len('bytes='):].partition('-')
+            offset = min(int(first), size)
+            end = min(int(last) + 1, size) if last else size
+            headers['Content-Range'] = f'bytes {offset}-{end - 1}/{size}'
+            code = 206
+        self.send_status(code, end - offset, headers)
+        if not send_body:
+            return
+
+        # An injected failure drops the connection somewhere in the middle of the file.
+        fail_at = random.randint(offset, end) if self.server.should_fail() else None
+        start = time.monotonic()
+        sent = 0
+        while offset < end:
+            length = min(SEND_BLOCK_SIZE, end - offset)
+            if fail_at is not None:
+                length = min(length, fail_at - offset)
+                if length <= 0:
+                    self.close_connection = True
+                    return
+            block = tree.read(path, offset, length)
+            try:
+                self.wfile.write(block)
+            except OSError:
+                # e.g. a client that only wanted part of the file.
+                self.close_connection = True
+                return
+            offset += len(block)
+            sent += len(block)
+
+            if self.server.bandwidth is not None:
+                ahead = sent / self.server.bandwidth - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def do_GET(self):
+        self.handle_request(True)
+
+    def do_HEAD(self):
+        self.handle_request(False)
+
+
+class FTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    handler_class = FTPStandInHandler
+
+    def __init__(self, tree: SyntheticTree, latency: float = 0.0, bandwidth: Optional[float] = None,
+                 failure_rate: float = 0.0, mlsd: bool = True, host: str = '127.0.0.1', port: int = 0):
+        """
+        :param latency: Seconds added before every reply and data connection, roughly one round trip.
+        :param bandwidth: Bytes per second for each data connection, unlimited if None.
+        :param failure_rate: Chance of refusing a new session or dropping a transfer part way through.
+        :param mlsd: Whether MLSD is supported, otherwise clients have to fall back to LIST.
+        """
+        super().__init__((host, port), self.handler_class)
+        self.tree = tree
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.mlsd = mlsd
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def should_fail(self) -> bool:
+        return self.failure_rate > 0 and random.random() < self.failure_rate
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class HTTPStandIn(FTPStandIn):
+    """The same as FTPStandIn, but speaking HTTP. mlsd is ignored."""
+
+    handler_class = HTTPStandInHandler
@@ -0,0 +1,149 @@
+"""
+SQLite index of everything macftp.py has listed, along with the download state of each file.
+
+Other tools can query the same database. Each row in items is one remote file:
+
+    path      Path relative to the FTP login directory, also the path under the download directory.
+    size      Size in bytes from the latest listing.
+    mtime     MLSD modify fact (YYYYMMDDHHMMSS) from the latest listing, NULL if the server only supports LIST.
+    sha256    Hash of the downloaded content, if known.
+    state     'new' (never downloaded), 'changed' (changed upstream, must be downloaded again from scratch), 'done', or
+              'streamed' (handed to preparevolume in memory with --stream, never saved, so still to be downloaded).
+    error     Last download error, cleared once the download succeeds.
+    snapshot  Id of the latest listing the file appeared in, see the snapshots table.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+STATE_NEW = 'new'
+STATE_CHANGED = 'changed'
+STATE_DONE = 'done'
+STATE_STREAMED = 'streamed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    taken_at REAL NOT NULL,
+    roots TEXT NOT NULL,
+    item_count INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS items (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime TEXT,
+    sha256 TEXT,
+    state TEXT NOT NULL,
+    error TEXT,
+    snapshot INTEGER REFERENCES snapshots(id),
+    downloaded_at REAL
+);
+
+CREATE INDEX IF NOT EXISTS items_state ON items(state);
+CREATE INDEX IF NOT EXISTS items_sha256 ON items(sha256);
+CREATE INDEX IF NOT EXISTS items_snapshot ON items(snapshot);
+'''
+
+# (size, path, mtime), in the same order as macftp's Item.
+Row = Tuple[int, str, Optional[str]]
+
+
+class ListingDatabase(object):
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        # Download workers record their results from their own threads, always while holding the lock.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM items LIMIT 1').fetchone() is None
+
+    def get_listing(self) -> Dict[str, Row]:
+        with self.lock:
+            return {path: (size, path, mtime) for size, path, mtime in
+                    self.connection.execute('SELECT size, path, mtime FROM items')}
+
+    def record_listing(self, roots: List[str], rows: Iterable[Row], changed: Set[str]):
+        """
+        Store a new listing of roots as a snapshot.
+        Files in changed have changed upstream since the last listing; they lose their hash and have to be downloaded
+        again from scratch. Every other file keeps its download state.
+        """
+        rows = list(rows)
+        with self.lock, self.connection:
+            snapshot = self.connection.execute(
+                'INSERT INTO snapshots (taken_at, roots, item_count) VALUES (?, ?, ?)',
+                (time.time(), json.dumps(roots), len(rows))).lastrowid
+
+            self.connection.executemany('''
+                INSERT INTO items (path, size, mtime, state, snapshot) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime,
+                                                snapshot = excluded.snapshot
+            ''', ((path, size, mtime, STATE_NEW, snapshot) for size, path, mtime in rows))
+
+            self.connection.executemany('''
+                UPDATE items SET state = ?, sha256 = NULL WHERE path = ?
+            ''', ((STATE_CHANGED, path) for path in changed))
+
+    def needs_fetching(self, roots: Optional[List[str]] = None) -> Tuple[List[Row], Set[str]]:
+        """
+        :param roots: Only return files under these directories.
+        :return: The files that haven't been downloaded, and which of them must restart from scratch.
+        """
+        result = self.select('state != ?', [STATE_DONE], roots)
+        rows = [(size, path, mtime) for size, path, mtime, _ in result]
+        changed = set(path for _, path, _, state in result if state == STATE_CHANGED)
+        return rows, changed
+
+    def downloaded(self, roots: Optional[List[str]] = None) -> List[Row]:
+        """
+        :param roots: Only return files under these directories.
+        :return: The files that have been downloaded and saved.
+        """
+        return [(size, path, mtime) for size, path, mtime, _ in self.select('state = ?', [STATE_DONE], roots)]
+
+    def select(self, condition: str, params: list,
+               roots: Optional[List[str]]) -> List[Tuple[int, str, Optional[str], str]]:
+        """:return: (size, path, mtime, state) of the files matching condition under roots, ordered by path."""
+        query = f'SELECT size, path, mtime, state FROM items WHERE {condition}'
+        if roots:
+            query += ' AND (' + ' OR '.join('path LIKE ? ESCAPE \'\\\'' for _ in roots) + ')'
+            params = params + [escape_like(root.rstrip('/')) + '/%' for root in roots]
+        query += ' ORDER BY path'
+
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def mark_done(self, path: str, sha256: Optional[str] = None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE items SET state = ?, sha256 = COALESCE(?, sha256), error = NULL, downloaded_at = ? '
+                'WHERE path = ?', (STATE_DONE, sha256, time.time(), path))
+
+    def mark_streamed(self, path: str):
+        """Record that a file was handed over in memory. A changed file stays changed, as any copy on disk is stale."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE items SET state = CASE WHEN state = ? THEN state ELSE ? END, error = NULL, downloaded_at = ? '
+                'WHERE path = ?', (STATE_CHANGED, STATE_STREAMED, time.time(), path))
+
+    def mark_failed(self, path: str, error: str):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE items SET error = ? WHERE path = ?', (error, path))
+
+
+def escape_like(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
@@ -1,32 +1,202 @@
 import os
-import ftplib
 import json
+import posixpath
 import argparse
+import collections
+import hashlib
+import queue
+import random
+import threading
+import time
+import traceback
+from typing import Optional, Set
+
+import archivecheck
+import fetchers
+import listingdb
+import throttle
+import transferstats
 
 # https://macintoshgarden.org/forum/public-access-file-repository
+# The default source, see --source for downloading from a mirror instead.
 FTP_URL = 'repo1.macintoshgarden.org'
 FTP_USER = 'macgarden'
 FTP_PASS = 'publicdl'
+FTP_PORT = 21
 
 DIR = 'Garden/apps'
 
-OUTPUT_DIR = os.path.join('./macdl', DIR)
+# Item names are paths relative to the FTP login directory, and are mirrored under OUTPUT_DIR.
+OUTPUT_DIR = './macdl'
 
 ALLOWED_EXTENSIONS = set(('.sit', '.dsk'))
 MAX_SIZE = 1024 * 1024 * 10  # 10 MB
 
+LISTING_DB_FILENAME = 'listing.db'
+
+# Listings used to be saved here, it is imported into LISTING_DB_FILENAME once.
 JSON_LIST_FILENAME = 'items.json'
 
+# Content-addressed mode (--content-addressed) keeps one copy of each unique download under STORE_DIR, named by its
+# SHA-256. Files in OUTPUT_DIR are hard links into the store.
+STORE_DIR = os.path.join(OUTPUT_DIR, 'sha256')
+MANIFEST_FILENAME = 'manifest.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Downloads in progress are written next to their final path with this suffix.
+# preparevolume.py skips files with this suffix.
+PARTIAL_SUFFIX = '.part'
+
+# Progress of a segmented download (see --segments) is kept next to its partial file with this suffix, ending in
+# PARTIAL_SUFFIX so preparevolume.py skips it too.
+SEGMENTS_SUFFIX = '.segments' + PARTIAL_SUFFIX
+SEGMENT_CHECKPOINT_BYTES = 1024 * 1024  # Record a segment's progress after this many bytes
+
+# Items still to be downloaded by the current run, see PendingQueue.
+PENDING_FILENAME = 'pending.json'
+
+RETRY_DELAY = 1.0  # Seconds, doubled after every consecutive failure.
+MAX_RETRY_DELAY = 60.0
+
+# modify is the MLSD modify fact (YYYYMMDDHHMMSS), or None when the entry came from a LIST.
+Item = collections.namedtuple('Item', ('size', 'name', 'modify'), defaults=(None,))
+
+
+# Options it doesn't know are passed on to preparevolume with --prepare, so they must not be taken for abbreviations of
+# its own, e.g. preparevolume's --cache for --cached-list.
+argparser = argparse.ArgumentParser(allow_abbrev=False)
+argparser.add_argument('--source', metavar='URL', action='append', dest='sources', help='Where to list and download from: ftp://[user[:password]@]host[:port][/base], '
+                       'http(s)://mirror/base/ with directory index pages, or a local directory such as a NAS mount. '
+                       f'Paths under the source must match the FTP server. Default is ftp://{FTP_URL}. '
+                       'Give it several times to spread connections over mirrors in proportion to their measured speed, '
+                       'failing over when one errors or stalls')
+argparser.add_argument('--stall-timeout', type=float, default=60.0, help='Seconds without progress before a network connection or transfer is given up on and retried. Default is 60')
+argparser.add_argument('--cached-list', help=f'Use cached listing of files in {LISTING_DB_FILENAME}, downloading only what still needs fetching', action='store_true')
+argparser.add_argument('--root', action='append', dest='roots', help=f'Directory to list. May be given multiple times. Default is {DIR}')
+argparser.add_argument('--recursive', action='store_true', help='Also list every subdirectory of the roots')
+argparser.add_argument('--pending', action='store_true', help=f'Download the items an interrupted or failed run left in {PENDING_FILENAME}, without listing')
+argparser.add_argument('--incremental', action='store_true', help='Only download entries that are new or changed since the last listing')
+argparser.add_argument('--connections', type=int, default=1, help='Number of connections to list and download with in parallel')
+argparser.add_argument('--content-addressed', action='store_true', help=f'Store each unique file once under {STORE_DIR} and record its SHA-256 in {MANIFEST_FILENAME}')
+argparser.add_argument('--retries', type=int, default=5, help='Number of times to reconnect and retry after a connection or transfer error')
+argparser.add_argument('--validate', action='store_true', help='Check StuffIt and HFS disk image headers as files arrive, downloading invalid files once more before giving up on them')
+argparser.add_argument('--segments', type=int, default=1, help='Download files of at least --segment-threshold bytes in this many ranges at once, each over its own connection. Default is 1, no segmenting')
+argparser.add_argument('--segment-threshold', type=throttle.parse_rate, default=4 * 1024 * 1024, help='Smallest file to download in segments, e.g. 4M. Default is 4M')
+argparser.add_argument('--max-rate', type=throttle.parse_rate, help='Limit the combined download rate, e.g. 500K or 2M bytes per second')
+argparser.add_argument('--adaptive', action='store_true', help='Adjust the number of active transfers (up to --connections) based on measured throughput and errors')
+argparser.add_argument('--fsync', choices=('file', 'batch', 'none'), default='batch', help='When to fsync finished downloads. Default is batch')
+argparser.add_argument('--fsync-batch-files', type=int, default=100, help='With --fsync batch, sync after this many files. Default is 100')
+argparser.add_argument('--fsync-batch-mb', type=int, default=64, help='With --fsync batch, sync after this many MiB. Default is 64')
+argparser.add_argument('--stats', metavar='FILE', help='Write per-transfer timings and aggregate statistics to FILE as JSON')
+argparser.add_argument('--prepare', metavar='SIT_DIR', help='Prepare volumes from files as they finish downloading, '
+                       'extracting archives into SIT_DIR. Unrecognized arguments are passed on to preparevolume.py. '
+                       'Items are added to volumes in the order they finish downloading.')
+argparser.add_argument('--stream', action='store_true', help=f'With --prepare, hand new downloads to preparevolume in memory instead of saving them in {OUTPUT_DIR}. '
+                       f'Files already in {OUTPUT_DIR} are still used, so leave this off to keep a cache of the downloads')
+
+
+class Crawl(object):
+    """State shared by all of the listing workers."""
+
+    def __init__(self, backend, roots, recursive, retries, stats):
+        self.backend = backend
+        self.directories = queue.Queue()
+        for root in roots:
+            self.directories.put(root)
+
+        self.recursive = recursive
+        self.retries = retries
+        self.stats = stats
+        self.attempts = collections.Counter()
+        self.items = []
+        self.failed = []
+
+        # Connections that are still usable when the crawl is done, so they can be reused for downloading.
+        self.sessions = []
+
+
+def list_worker(session, crawl):
+    """List directories from the crawl's queue until a None is received."""
+    while True:
+        path = crawl.directories.get()
+        if path is None:
+            break
+
+        try:
+            if session is None:
+                session = connect_with_retries(crawl.backend, crawl.retries, crawl.stats)
+            print(f'Listing {path}')
+            files, directories = session.list_directory(path)
+            crawl.items.extend(Item(*row) for row in files)
+            if crawl.recursive:
+                for directory in directories:
+                    crawl.directories.put(directory)
+        except fetchers.PermanentError as e:
+            print(f'Error listing {path}: {e}')
+            crawl.failed.append(path)
+        except Exception:
+            traceback.print_exc()
+            if session is not None:
+                session.close()
+                session = None
+
+            crawl.attempts[path] += 1
+            if crawl.attempts[path] > crawl.retries:
+                print(f'Error listing {path}, giving up.')
+                crawl.failed.append(path)
+            else:
+                delay = retry_delay(crawl.attempts[path])
+                print(f'Error listing {path}, retrying in {delay:.0f}s.')
+                time.sleep(delay)
+                crawl.directories.put(path)
+        finally:
+            crawl.directories.task_done()
+
+    if session is not None:
+        crawl.sessions.append(session)
+
 
-argparser = argparse.ArgumentParser()
-argparser.add_argument('--cached-list', help='Use cached listing of files', action='store_true')
+def list_items(backend, session, roots, recursive, connections, retries, stats=None):
+    """
+    List all of the roots, with one listing worker per connection.
+    :param session: An open session of backend for the first worker, the others connect their own.
+    :return: The Crawl, with its items sorted by path.
+    """
+    crawl = Crawl(backend, roots, recursive, retries, stats)
 
+    workers = [threading.Thread(target=list_worker, args=(session if i == 0 else None, crawl))
+               for i in range(max(connections, 1))]
+    for worker in workers:
+        worker.start()
 
-def parse_item(line):
-    parts = [x for x in line.split(' ') if len(x) > 0]
-    size = parts[4]
-    name = parts[8]
-    return int(size), name
+    crawl.directories.join()
+    for _ in workers:
+        crawl.directories.put(None)
+    for worker in workers:
+        worker.join()
+
+    if crawl.failed:
+        print(f'Failed to list {len(crawl.failed)} directories:')
+        for path in crawl.failed:
+            print(f'  {path}')
+
+    crawl.items.sort(key=lambda item: item.name)
+    return crawl
+
+
+def load_json_items():
+    with open(JSON_LIST_FILENAME) as f:
+        items = [Item(*entry) for entry in json.load(f)]
+
+    # Listings saved before multiple roots were supported only have names relative to DIR.
+    return [item if '/' in item.name else item._replace(name=posixpath.join(DIR, item.name)) for item in items]
+
+
+def is_changed(previous, item):
+    if previous.size != item.size:
+        return True
+    # Without modify facts on both sides (e.g. a LIST fallback), the size is all we have to go on.
+    return previous.modify is not None and item.modify is not None and previous.modify != item.modify
 
 
 def should_include(size, name):
@@ -35,72 +205,860 @@ def should_include(size, name):
 
 
 def exists(local_path, size, name):
-    local_path = os.path.join(OUTPUT_DIR, name)
     if not os.path.isfile(local_path):
         return False
     return os.path.getsize(local_path) == size
 
-def download(ftp, size, name):
+def hash_file(path, hasher, length=None):
+    """Feed the first length bytes of the file at path (all of it by default) into hasher."""
+    with open(path, 'rb') as f:
+        while length is None or length > 0:
+            chunk = f.read(HASH_CHUNK_SIZE if length is None else min(HASH_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if length is not None:
+                length -= len(chunk)
+    return hasher
+
+
+class Manifest(object):
+    """Maps downloaded file names to the size and SHA-256 of their contents."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def store(self, name, local_path, size, digest):
+        """
+        Move a finished download into the store, leaving a hard link at local_path.
+        If the store already has the same content, local_path is replaced by a link to it, freeing the new copy.
+        :return: True if the content was already in the store.
+        """
+        store_path = os.path.join(STORE_DIR, digest[:2], digest)
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+
+        try:
+            os.link(local_path, store_path)
+            duplicate = False
+        except FileExistsError:
+            duplicate = not os.path.samefile(local_path, store_path)
+            if duplicate:
+                temp_path = local_path + '.link'
+                os.link(store_path, temp_path)
+                os.replace(temp_path, local_path)
+
+        with self.lock:
+            self.entries[name] = {'size': size, 'sha256': digest}
+        return duplicate
+
+    def save(self):
+        with self.lock:
+            with open(self.path, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+
+
+def download(session, job, size, name):
+    restart = name in job.changed
+    manifest = job.manifest
+
     local_path = os.path.join(OUTPUT_DIR, name)
-    
-    if exists(local_path, size, name):
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+    if not restart and exists(local_path, size, name):
         print(f'File already downloaded: {name} ({size})')
-        return
+        if manifest is not None and manifest.get(name) is None:
+            manifest.store(name, local_path, size, hash_file(local_path, hashlib.sha256()).hexdigest())
+        return local_path
 
-    print(f'Downloading {name} ({size})')
-    with open(local_path, 'wb') as f:
-        result = ftp.retrbinary('RETR ' + name, f.write)
+    # Downloads go to a temporary name and are only renamed once complete, so nothing downstream ever sees a partial
+    # file under the real name. This also means a file linked into the store is never written in place.
+    partial_path = local_path + PARTIAL_SUFFIX
+    segments_path = local_path + SEGMENTS_SUFFIX
+    if restart and os.path.isfile(partial_path):
+        os.remove(partial_path)
+    if os.path.isfile(segments_path) and not os.path.isfile(partial_path):
+        os.remove(segments_path)
+
+    # A short file under the real name was left by a download written in place, before temporary names were used.
+    if (not restart and not os.path.isfile(partial_path) and os.path.isfile(local_path)
+            and os.stat(local_path).st_nlink == 1 and os.path.getsize(local_path) < size):
+        os.replace(local_path, partial_path)
+
+    if os.path.isfile(segments_path) or (job.segments > 1 and size >= job.segment_threshold
+                                         and not os.path.isfile(partial_path)):
+        return download_segmented(session, job, size, name, local_path, partial_path, segments_path)
+
+    # Continue a partial file left behind by an interrupted transfer. A local file larger than the listed size can't
+    # be a prefix of the remote file, so start that one over.
+    offset = os.path.getsize(partial_path) if os.path.isfile(partial_path) else 0
+    if offset > size:
+        offset = 0
+
+    hasher = None
+    if manifest is not None:
+        hasher = hashlib.sha256()
+        if offset > 0:
+            hash_file(partial_path, hasher, offset)
+
+    validator = None
+    if job.validate:
+        validator = archivecheck.ArchiveValidator(name, size)
+        if offset > 0:
+            with open(partial_path, 'rb') as f:
+                validator.feed(f.read(min(offset, validator.needed)))
+
+    if offset > 0:
+        print(f'Resuming {name} at {offset} ({size})')
+        mode = 'ab'
+    else:
+        print(f'Downloading {name} ({size})')
+        mode = 'wb'
+
+    with open(partial_path, mode) as f:
+        def write(block):
+            if job.rate_limit is not None:
+                job.rate_limit.consume(len(block))
+            if validator is not None:
+                validator.feed(block)
+            f.write(block)
+            if hasher is not None:
+                hasher.update(block)
+            if job.concurrency is not None:
+                job.concurrency.record(len(block))
+
+        result, setup, first_byte, duration = session.retrieve(name, write, offset)
+
+        if f.tell() != size:
+            raise EOFError(f'Transfer of {name} ended after {f.tell()} of {size} bytes')
+        if validator is not None:
+            validator.finish()
+        if job.syncer is not None:
+            job.syncer.before_rename(f)
     print(f'  result: {result}')
 
+    if job.stats is not None:
+        job.stats.add_transfer(name, offset, size - offset, setup, first_byte, duration)
 
-args = argparser.parse_args()
+    finish_download(job, name, local_path, partial_path, size, size - offset,
+                    hasher.hexdigest() if hasher is not None else None)
+    return local_path
 
-try:
-    print('Connecting to FTP...')
-    ftp = ftplib.FTP(FTP_URL, user=FTP_USER, passwd=FTP_PASS)
-    print(f'Setting FTP directory to {DIR}')
-    ftp.cwd(DIR)
 
-    items = []
-    all_items = []
+def finish_download(job, name, local_path, partial_path, size, byte_count, digest):
+    """Rename a complete download into place, and in content-addressed mode move it into the store."""
+    os.replace(partial_path, local_path)
+    if job.syncer is not None:
+        job.syncer.after_rename(local_path, byte_count)
 
-    def add_item(item):
-        size, name = item
-        all_items.append(item)
+    if digest is not None:
+        if job.manifest.store(name, local_path, size, digest):
+            print(f'  duplicate content, already stored as {digest}')
 
-        will_include = should_include(size, name)
-        print(f'{"+" if will_include else "-"} {name} ({size})')
-        
-        if will_include:
-            items.append(item)
 
-    def item_callback(line):
-        item = parse_item(line)
-        add_item(item)
+class SegmentCancelled(Exception):
+    pass
 
-    if not args.cached_list:
-        ftp.retrlines('LIST', callback=item_callback)
 
-        print('Saving all_items as JSON...')
-        with open(JSON_LIST_FILENAME, 'w') as f:
-            json.dump(all_items, f)
+def load_segments(path, size):
+    """:return: The [start, position, end] of each segment of a segmented download, None if there's no usable state."""
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    return state['segments'] if state['size'] == size else None
+
+
+def save_segments(path, size, segments):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'size': size, 'segments': segments}, f)
+    os.replace(temp_path, path)
+
+
+def preallocate(f, size):
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError):
+        # Not available on this platform or file system, a sparse file will do.
+        f.truncate(size)
+
+
+def download_segmented(session, job, size, name, local_path, partial_path, segments_path):
+    """
+    Download a file in job.segments byte ranges at once, each over its own session, into a preallocated partial file.
+
+    The last segment runs to the end of the file over session, so the worker's own session is never left part way
+    through a transfer; the others each open a session and end it afterwards. Progress is recorded in segments_path as
+    each segment stops, so a failed or interrupted download picks up every segment where it left off.
+    """
+    segments = load_segments(segments_path, size)
+    if segments is None:
+        bounds = [size * i // job.segments for i in range(job.segments + 1)]
+        segments = [[bounds[i], bounds[i], bounds[i + 1]] for i in range(job.segments)]
+        # Saved before preallocating, so a full-size partial file is never mistaken for a complete single download.
+        save_segments(segments_path, size, segments)
+        with open(partial_path, 'wb') as f:
+            preallocate(f, size)
+        print(f'Downloading {name} ({size}) in {len(segments)} segments')
     else:
-        print('Loading items from JSON...')
-        with open(JSON_LIST_FILENAME) as f:
-            cached_items = json.load(f)
+        done = sum(position - start for start, position, _ in segments)
+        print(f'Resuming {name} ({size}) in {len(segments)} segments, {done} bytes already downloaded')
+    byte_count = sum(end - position for _, position, end in segments)
+
+    validator = None
+    if job.validate:
+        validator = archivecheck.ArchiveValidator(name, size)
+        if segments[0][1] > 0:
+            with open(partial_path, 'rb') as f:
+                validator.feed(f.read(min(segments[0][1], validator.needed)))
+
+    lock = threading.Lock()
+    # Positions that have been flushed to the partial file, and are safe to record.
+    saved = [list(segment) for segment in segments]
+    errors = []
+    # Set when a segment fails in a way that retrying can't fix, to stop the others.
+    cancel = threading.Event()
+
+    def checkpoint(index, f):
+        f.flush()
+        with lock:
+            saved[index][1] = segments[index][1]
+            save_segments(segments_path, size, saved)
+
+    def fetch(index, segment_session):
+        segment = segments[index]
+        start, end = segment[1], segment[2]
+        if start >= end:
+            return
+        own_session = segment_session is None
+        try:
+            if own_session:
+                segment_session = connect_with_retries(job.backend, job.retries, job.stats)
+
+            with open(partial_path, 'r+b') as f:
+                f.seek(start)
+
+                def write(block):
+                    if cancel.is_set():
+                        raise SegmentCancelled()
+                    if job.rate_limit is not None:
+                        job.rate_limit.consume(len(block))
+                    if validator is not None and index == 0:
+                        validator.feed(block)
+                    f.write(block)
+                    segment[1] += len(block)
+                    if segment[1] - saved[index][1] >= SEGMENT_CHECKPOINT_BYTES:
+                        checkpoint(index, f)
+                    if job.concurrency is not None:
+                        job.concurrency.record(len(block))
+
+                try:
+                    result, setup, first_byte, duration = segment_session.retrieve(
+                        name, write, start, None if end == size else end - start)
+                finally:
+                    checkpoint(index, f)
+
+            if segment[1] != end:
+                raise EOFError(f'Segment {start}-{end} of {name} ended at {segment[1]}')
+            if job.stats is not None:
+                job.stats.add_transfer(name, start, end - start, setup, first_byte, duration)
+        except Exception as e:
+            if isinstance(e, (archivecheck.InvalidArchive, fetchers.PermanentError)):
+                cancel.set()
+            if not isinstance(e, SegmentCancelled):
+                errors.append(e)
+            if own_session and segment_session is not None:
+                segment_session.close()
+                segment_session = None
+        finally:
+            if own_session and segment_session is not None:
+                segment_session.quit()
+
+    threads = [threading.Thread(target=fetch, args=(i, session if i == len(segments) - 1 else None))
+               for i in range(len(segments))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        # Problems with the file itself take precedence over connection errors, which would only be retried.
+        errors.sort(key=lambda e: not isinstance(e, (archivecheck.InvalidArchive, fetchers.PermanentError)))
+        raise errors[0]
+
+    if validator is not None:
+        validator.finish()
+    digest = None
+    if job.manifest is not None:
+        digest = hash_file(partial_path, hashlib.sha256()).hexdigest()
+    if job.syncer is not None:
+        with open(partial_path, 'r+b') as f:
+            job.syncer.before_rename(f)
+
+    finish_download(job, name, local_path, partial_path, size, byte_count, digest)
+    os.remove(segments_path)
+    return local_path
+
+
+def download_to_memory(session, job, size, name):
+    """
+    Download a file into memory, for --stream. It can't be resumed, so an interrupted transfer starts over.
+    :return: The contents of the file.
+    """
+    validator = archivecheck.ArchiveValidator(name, size) if job.validate else None
+    print(f'Downloading {name} ({size}) into memory')
+
+    buffer = bytearray()
+
+    def write(block):
+        if job.rate_limit is not None:
+            job.rate_limit.consume(len(block))
+        if validator is not None:
+            validator.feed(block)
+        buffer.extend(block)
+        if job.concurrency is not None:
+            job.concurrency.record(len(block))
+
+    result, setup, first_byte, duration = session.retrieve(name, write)
+
+    if len(buffer) != size:
+        raise EOFError(f'Transfer of {name} ended after {len(buffer)} of {size} bytes')
+    if validator is not None:
+        validator.finish()
+    print(f'  result: {result}')
+
+    if job.stats is not None:
+        job.stats.add_transfer(name, 0, size, setup, first_byte, duration)
+    return bytes(buffer)
+
+
+class Syncer(object):
+    """
+    Applies the --fsync policy to finished downloads.
+
+    'file' syncs each download before it is renamed into place. 'batch' renames right away and syncs everything
+    renamed since the last batch once enough files or bytes have accumulated; a crash inside a batch can leave a
+    renamed file short or empty, which the size check picks up and downloads again on the next run. 'none' leaves it
+    all to the OS.
+    """
+
+    def __init__(self, policy, batch_files, batch_bytes):
+        self.policy = policy
+        self.batch_files = batch_files
+        self.batch_bytes = batch_bytes
+        self.lock = threading.Lock()
+        self.paths = []
+        self.bytes = 0
+
+    def before_rename(self, f):
+        if self.policy == 'file':
+            f.flush()
+            os.fsync(f.fileno())
+
+    def after_rename(self, path, byte_count):
+        if self.policy == 'file':
+            sync_path(os.path.dirname(path))
+        elif self.policy == 'batch':
+            with self.lock:
+                self.paths.append(path)
+                self.bytes += byte_count
+                full = len(self.paths) >= self.batch_files or self.bytes >= self.batch_bytes
+            if full:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            paths = self.paths
+            self.paths = []
+            self.bytes = 0
+
+        for path in paths:
+            sync_path(path)
+        for directory in set(os.path.dirname(path) for path in paths):
+            sync_path(directory)
+
+
+def sync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def retry_delay(failures):
+    """Exponential backoff with jitter, so reconnecting connections don't all hit the server at once."""
+    return min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (failures - 1)) * random.uniform(0.5, 1.0)
+
+
+def connect_with_retries(backend, retries, stats=None):
+    failures = 0
+    while True:
+        try:
+            start = time.monotonic()
+            session = backend.connect()
+            if stats is not None:
+                stats.add_connect(time.monotonic() - start)
+            return session
+        except backend.errors as e:
+            failures += 1
+            if failures > retries:
+                raise
+            delay = retry_delay(failures)
+            print(f'Error connecting to {backend} ({e}), retrying in {delay:.0f}s.')
+            time.sleep(delay)
+
+
+class PendingQueue(object):
+    """
+    Persists the items a run still has to download, so an interrupted run can be picked up again with --pending.
+
+    The full list is written once when downloading starts. Finished items are appended to a journal next to it,
+    instead of rewriting the list after every file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + '.done'
+        self.lock = threading.Lock()
+        self.done = set()
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def load(self):
+        """:return: The items that haven't been marked done, and the names of those that must restart from scratch."""
+        with open(self.path) as f:
+            entries = json.load(f)
+
+        done = set()
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path) as f:
+                done = set(line.rstrip('\n') for line in f)
+
+        items = [Item(*entry['item']) for entry in entries if entry['item'][1] not in done]
+        changed = set(entry['item'][1] for entry in entries if entry['restart'] and entry['item'][1] not in done)
+        return items, changed
+
+    def save(self, items, changed):
+        entries = [{'item': item, 'restart': item.name in changed} for item in items]
+        with self.lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(temp_path, self.path)
+
+            self.done = set()
+            if os.path.isfile(self.journal_path):
+                os.remove(self.journal_path)
+
+    def mark_done(self, name):
+        with self.lock:
+            self.done.add(name)
+            with open(self.journal_path, 'a') as f:
+                f.write(name + '\n')
+
+    def remove(self):
+        with self.lock:
+            for path in (self.path, self.journal_path):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+
+class DownloadJob(object):
+    """State shared by all of the download workers."""
+
+    def __init__(self, backend, items, changed):
+        self.backend = backend
+        self.work_queue = queue.Queue()
+        for item in items:
+            self.work_queue.put(item)
+
+        # Names of entries whose local copy is stale and must be downloaded again from scratch.
+        self.changed = changed
+        self.failed = []
+
+        self.retries = 0
+        self.attempts = collections.Counter()
+
+        # With validation on, names of files that failed validation once and are being downloaded again.
+        self.validate = False
+        self.refetched = set()
+        self.pending: Optional[PendingQueue] = None
+        self.listing: Optional[listingdb.ListingDatabase] = None
+        self.stats: Optional[transferstats.TransferStats] = None
+        self.syncer: Optional[Syncer] = None
+
+        # Set in content-addressed mode.
+        self.manifest: Optional[Manifest] = None
+
+        # Files of at least segment_threshold bytes are downloaded in this many ranges at once.
+        self.segments = 1
+        self.segment_threshold = 0
+
+        self.rate_limit: Optional[throttle.TokenBucket] = None
+        self.concurrency: Optional[throttle.ConcurrencyController] = None
+
+        # (local path, contents) of finished downloads are put here when they are being handed off to preparevolume.
+        # The contents are None if the download was saved at the local path.
+        self.downloaded: Optional[queue.Queue] = None
+
+        # Hand new downloads to preparevolume in memory, without saving them.
+        self.stream = False
+        # Names of the items handed over in memory. They aren't on disk, so they are never marked done.
+        self.streamed: Set[str] = set()
+        # What stopped preparation, raised once the downloads are wrapped up.
+        self.prepare_error: Optional[Exception] = None
+
+
+def download_worker(session, job):
+    """
+    Download items from the job's work queue until it is empty.
+
+    A permanent error (e.g. a missing file) only fails that item. After any other error the session is in an unknown
+    state, so it is dropped and the item goes back on the queue to be retried over a new connection, after a backoff.
+    """
+    started = time.monotonic()
+    transferring = 0.0
+    try:
+        while True:
+            try:
+                item = job.work_queue.get_nowait()
+            except queue.Empty:
+                return
+            size, name, _ = item
+
+            if session is None:
+                try:
+                    session = connect_with_retries(job.backend, job.retries, job.stats)
+                except job.backend.errors:
+                    traceback.print_exc()
+                    print(f'Unable to connect to {job.backend}, giving up on this connection.')
+                    job.work_queue.put(item)
+                    return
+
+            if job.concurrency is not None:
+                job.concurrency.acquire()
+            ok = False
+            transfer_start = time.monotonic()
+            try:
+                local_path = os.path.join(OUTPUT_DIR, name)
+                data = None
+                if job.stream and (name in job.changed or not exists(local_path, size, name)):
+                    data = download_to_memory(session, job, size, name)
+                else:
+                    local_path = download(session, job, size, name)
+                ok = True
+            except archivecheck.InvalidArchive as e:
+                # The transfer may have been abandoned part way through, leaving the session in an unknown state.
+                session.close()
+                session = None
+                ok = True
+
+                base_path = os.path.join(OUTPUT_DIR, name)
+                for path in (base_path + PARTIAL_SUFFIX, base_path + SEGMENTS_SUFFIX):
+                    if os.path.isfile(path):
+                        os.remove(path)
+
+                if name not in job.refetched:
+                    print(f'{name} is invalid ({e}), downloading it again.')
+                    job.refetched.add(name)
+                    job.work_queue.put(item)
+                else:
+                    print(f'{name} is invalid ({e}), giving up.')
+                    job.failed.append(name)
+                    if job.stats is not None:
+                        job.stats.add_failure(name, f'Invalid: {e}')
+                    if job.listing is not None:
+                        job.listing.mark_failed(name, f'Invalid: {e}')
+                continue
+            except fetchers.PermanentError as e:
+                # The server answered, so this isn't a sign of congestion.
+                ok = None
+                print(f'Error downloading {name}: {e}')
+                job.failed.append(name)
+                if job.stats is not None:
+                    job.stats.add_failure(name, str(e))
+                if job.listing is not None:
+                    job.listing.mark_failed(name, str(e))
+                continue
+            except Exception as e:
+                if not isinstance(e, job.backend.errors):
+                    # Not a timeout, connection error or temporary reply from the server, so not a sign of congestion.
+                    ok = None
+                traceback.print_exc()
+                if job.stats is not None:
+                    job.stats.add_failure(name, repr(e))
+                session.close()
+                session = None
+
+                job.attempts[name] += 1
+                if job.attempts[name] > job.retries:
+                    print(f'Error downloading {name}, giving up.')
+                    job.failed.append(name)
+                    if job.listing is not None:
+                        job.listing.mark_failed(name, repr(e))
+                else:
+                    delay = retry_delay(job.attempts[name])
+                    print(f'Error downloading {name}, retrying in {delay:.0f}s.')
+                    time.sleep(delay)
+                    job.work_queue.put(item)
+                continue
+            finally:
+                transferring += time.monotonic() - transfer_start
+                if job.concurrency is not None:
+                    job.concurrency.release(ok)
+
+            # Connections move between mirrors as their speeds are measured.
+            if isinstance(job.backend, fetchers.MirrorSet) and job.backend.should_move(session):
+                session.quit()
+                session = None
+
+            if data is not None:
+                # Left out of the pending journal, so they are downloaded again if the run is interrupted before
+                # their volume is written.
+                job.streamed.add(name)
+                if job.listing is not None:
+                    job.listing.mark_streamed(name)
+            else:
+                if job.pending is not None:
+                    job.pending.mark_done(name)
+                if job.listing is not None:
+                    entry = job.manifest.get(name) if job.manifest is not None else None
+                    job.listing.mark_done(name, entry['sha256'] if entry is not None else None)
+            if job.downloaded is not None:
+                job.downloaded.put((local_path, data))
+    finally:
+        if session is not None:
+            session.quit()
+        if job.stats is not None:
+            job.stats.add_worker(transferring, time.monotonic() - started)
+
+
+def prepare_worker(job, existing_paths):
+    """
+    Feed finished downloads into preparevolume until a None is received. If preparation fails, the error is kept in
+    job.prepare_error and the rest of the downloads are only taken off the queue, so the download workers never block.
+    :param existing_paths: Files downloaded by earlier runs that aren't downloaded again, prepared first.
+    """
+    import preparevolume
+
+    entry = ()
+    try:
+        volume_manager = preparevolume.create_volume_manager()
+        preparer = preparevolume.Preparer(volume_manager)
+        for path in existing_paths:
+            preparer.submit(path)
+        while True:
+            entry = job.downloaded.get()
+            if entry is None:
+                break
+
+            path, data = entry
+            preparer.submit(path, data)
+
+        # Writes the last volume if anything was added to it.
+        preparer.finish()
+    except Exception as e:
+        job.prepare_error = e
+        print(f'Preparation failed ({e!r}), the remaining items are only downloaded.')
+        # Nothing would take them from memory any more.
+        job.stream = False
+        while entry is not None:
+            entry = job.downloaded.get()
+
+
+def main(argv=None):
+    args, prepare_argv = argparser.parse_known_args(argv)
+    if args.prepare is None:
+        if prepare_argv:
+            argparser.error(f'unrecognized arguments: {" ".join(prepare_argv)}')
+    else:
+        import preparevolume
+        preparevolume.parse_args([OUTPUT_DIR, args.prepare] + prepare_argv)
+
+    if sum((args.pending, args.cached_list, args.incremental)) > 1:
+        argparser.error('only one of --pending, --cached-list and --incremental may be given')
+    if args.stream and args.prepare is None:
+        argparser.error('--stream only makes sense with --prepare')
+    if args.stream and args.content_addressed:
+        argparser.error('--content-addressed needs downloads saved to disk, it can\'t be combined with --stream')
+
+    roots = args.roots or [DIR]
+
+    pending = PendingQueue(PENDING_FILENAME)
+    stats = transferstats.TransferStats() if args.stats is not None else None
+
+    if args.sources:
+        try:
+            backends = [fetchers.open_backend(source, args.stall_timeout) for source in args.sources]
+        except ValueError as e:
+            argparser.error(str(e))
+        backend = backends[0] if len(backends) == 1 else fetchers.MirrorSet(backends)
+    else:
+        backend = fetchers.FTPBackend(FTP_URL, FTP_PORT, FTP_USER, FTP_PASS, timeout=args.stall_timeout)
+
+    session = None
+    try:
+        session = connect_with_retries(backend, args.retries, stats)
+
+        items = []
+        changed = set()
+
+        # The listing connections are reused for downloading.
+        sessions = [session]
+        session = None
+
+        listing = listingdb.ListingDatabase(LISTING_DB_FILENAME)
+        if listing.is_empty() and os.path.isfile(JSON_LIST_FILENAME):
+            print(f'Importing {JSON_LIST_FILENAME} into {LISTING_DB_FILENAME}...')
+            listing.record_listing([DIR], load_json_items(), set())
+
+        if args.pending:
+            print(f'Loading pending items from {PENDING_FILENAME}...')
+            items, changed = pending.load()
+            for item in items:
+                print(f'{"*" if item.name in changed else "+"} {item.name} ({item.size})')
+        elif args.cached_list:
+            print(f'Loading items that still need fetching from {LISTING_DB_FILENAME}...')
+            rows, changed = listing.needs_fetching(args.roots)
+            items = [Item(*row) for row in rows if should_include(row[0], row[1])]
+            print(f'{len(items)} items to fetch')
+        else:
+            previous_items = listing.get_listing()
+            crawl = list_items(backend, sessions[0], roots, args.recursive, args.connections, args.retries, stats)
+            sessions = crawl.sessions
+
+            listed_changed = set(item.name for item in crawl.items
+                                 if item.name in previous_items and is_changed(Item(*previous_items[item.name]), item))
+            print(f'Saving listing to {LISTING_DB_FILENAME}...')
+            listing.record_listing(roots, crawl.items, listed_changed)
+
+            # Also includes files that changed in an earlier listing but haven't been downloaded again yet.
+            rows, changed = listing.needs_fetching(roots)
+
+            if args.incremental:
+                print(f'Compared listing against {len(previous_items)} previously listed items')
+                listed = set(item.name for item in crawl.items)
+                for row in rows:
+                    item = Item(*row)
+                    if item.name in listed and should_include(item.size, item.name):
+                        print(f'{"*" if item.name in changed else "+"} {item.name} ({item.size})')
+                        items.append(item)
+            else:
+                for item in crawl.items:
+                    will_include = should_include(item.size, item.name)
+                    print(f'{"+" if will_include else "-"} {item.name} ({item.size})')
+
+                    if will_include:
+                        items.append(item)
+
+        print('Downloading items')
+
+        job = DownloadJob(backend, items, changed)
+        job.retries = args.retries
+        job.pending = pending
+        job.stats = stats
+        job.listing = listing
+        job.validate = args.validate
+        job.segments = max(args.segments, 1)
+        job.segment_threshold = args.segment_threshold
+        job.stream = args.stream
+        job.syncer = Syncer(args.fsync, args.fsync_batch_files, args.fsync_batch_mb * 1024 * 1024)
+        pending.save(items, changed)
+        if args.content_addressed:
+            job.manifest = Manifest(MANIFEST_FILENAME)
+        if args.max_rate is not None:
+            job.rate_limit = throttle.TokenBucket(args.max_rate)
+        if args.adaptive:
+            job.concurrency = throttle.ConcurrencyController(1, args.connections)
+
+        preparer = None
+        if args.prepare is not None:
+            # When streaming, downloads wait here in memory, so only let a few pile up ahead of preparation.
+            job.downloaded = queue.Queue(maxsize=2 * max(args.connections, 1) if args.stream else 0)
+            # With --pending, --cached-list and --incremental only part of the collection is downloaded, but the volumes
+            # still have to hold all of it, like they would after a full run.
+            existing_paths = []
+            if args.pending or args.cached_list or args.incremental:
+                fetching = set(item.name for item in items)
+                for size, name, _ in listing.downloaded(roots if args.incremental else args.roots):
+                    local_path = os.path.join(OUTPUT_DIR, name)
+                    if name not in fetching and should_include(size, name) and exists(local_path, size, name):
+                        existing_paths.append(local_path)
+                print(f'Preparing {len(existing_paths)} items downloaded by earlier runs too')
+            preparer = threading.Thread(target=prepare_worker, args=(job, existing_paths))
+            preparer.start()
+
+        workers = [threading.Thread(target=download_worker, args=(sessions[i] if i < len(sessions) else None, job))
+                   for i in range(max(args.connections, 1))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        job.syncer.flush()
+
+        if preparer is not None:
+            print('Waiting for preparation to finish...')
+            job.downloaded.put(None)
+            preparer.join()
+
+        if job.manifest is not None:
+            print(f'Saving manifest to {MANIFEST_FILENAME}...')
+            job.manifest.save()
+
+        not_downloaded = set(job.failed)
+        if not job.work_queue.empty():
+            print(f'{job.work_queue.qsize()} items were not downloaded because all connections failed.')
+            while not job.work_queue.empty():
+                not_downloaded.add(job.work_queue.get_nowait().name)
+        if job.failed:
+            print(f'Failed to download {len(job.failed)} items:')
+            for name in job.failed:
+                print(f'  {name}')
+
+        if not_downloaded:
+            print(f'Saving {len(not_downloaded)} items that were not downloaded to {PENDING_FILENAME}, use --pending to retry them.')
+            pending.save([item for item in items if item.name not in pending.done and item.name not in job.streamed],
+                         changed)
+        else:
+            pending.remove()
+
+        if isinstance(backend, fetchers.MirrorSet):
+            mirrors = backend.report()
+            print('Mirrors:')
+            for mirror in mirrors:
+                speed = 'unknown' if mirror['speed'] is None else f'{mirror["speed"] / 1024:.0f} KiB/s'
+                print(f'  {mirror["source"]}: {mirror["transfers"]} transfers, {mirror["bytes"]} bytes, '
+                      f'{speed} per connection, {mirror["errors"]} errors')
+            if stats is not None:
+                stats.add_section('mirrors', mirrors)
+
+        if stats is not None:
+            print(f'Writing stats to {args.stats}...')
+            stats.write(args.stats)
 
-        for item in cached_items:
-            add_item(item)
+        listing.close()
 
-    print('Downloading items')
+        if job.prepare_error is not None:
+            raise job.prepare_error
 
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
+        print('done!')
 
-    for size, name in items:
-        download(ftp, size, name)
+    finally:
+        if session is not None:
+            session.quit()
 
-    print('done!')
 
-finally:
-    print('Calling ftp.quit()')
-    ftp.quit()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+SQLite cache of what preparevolume.py made of each top-level item, so unchanged items are not extracted and parsed
+again on the next run. Each row in items is one prepared input:
+
+    path          Path of the input as it was given to preparevolume.
+    key           What identifies the input's contents, see input_key() and data_key().
+    version       CACHE_VERSION the row was written with. Rows from other versions are ignored.
+    result        Pickled (tree, HFS name, bytes taken) as returned by add_file, or NULL when it returned nothing.
+    prepared_at   When the row was written.
+
+Each row in rejections is an input that didn't make it into a volume, with the same path, key and version columns:
+
+    kind          REJECTION_FILTERED if a FilterException left it out, REJECTION_FAILED for a PreparationIssue.
+    reason        The exception's message.
+    rejected_at   When the row was written.
+
+An input has a row in at most one of the tables.
+"""
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+# Bump whenever a change to preparevolume.py changes what it makes of the same input.
+CACHE_VERSION = 2
+
+KEY_MTIME = 'mtime'
+KEY_HASH = 'hash'
+
+REJECTION_FILTERED = 'filtered'
+REJECTION_FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    path TEXT NOT NULL,
+    key TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    result BLOB,
+    prepared_at REAL NOT NULL,
+    PRIMARY KEY (path, key)
+);
+
+CREATE TABLE IF NOT EXISTS rejections (
+    path TEXT NOT NULL,
+    key TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    rejected_at REAL NOT NULL,
+    PRIMARY KEY (path, key)
+);
+'''
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def input_key(path: str, by: str = KEY_MTIME) -> str:
+    """
+    :param by: KEY_MTIME to identify the input by size and modification time, KEY_HASH to hash its contents.
+    :return: The key for the input at path, covering the .rsrc file next to it, which add_file reads too.
+    """
+    parts = []
+    for part_path in (path, path + '.rsrc'):
+        if not os.path.isfile(part_path):
+            continue
+        if by == KEY_HASH:
+            parts.append(f'sha256:{file_hash(part_path)}')
+        else:
+            stat = os.stat(part_path)
+            parts.append(f'stat:{stat.st_size}:{stat.st_mtime_ns}')
+    return '+'.join(parts)
+
+
+def data_key(data: bytes) -> str:
+    """:return: The key for an input that is only in memory."""
+    return f'sha256:{hashlib.sha256(data).hexdigest()}'
+
+
+class PreparedCache(object):
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        # Looked up and filled from the preparation stages' threads, always while holding the lock.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get(self, path: str, key: str) -> Tuple[bool, Optional[tuple]]:
+        """:return: Whether the input's result is cached, and the result."""
+        with self.lock:
+            row = self.connection.execute('SELECT result FROM items WHERE path = ? AND key = ? AND version = ?',
+                                          (path, key, CACHE_VERSION)).fetchone()
+        if row is None:
+            return False, None
+        result, = row
+        return True, pickle.loads(result) if result is not None else None
+
+    def put(self, path: str, key: str, result: Optional[tuple]):
+        """Store what the input was prepared into. Older rows for the same path are replaced."""
+        blob = pickle.dumps(result, pickle.HIGHEST_PROTOCOL) if result is not None else None
+        with self.lock, self.connection:
+            self.forget(path)
+            self.connection.execute(
+                'INSERT INTO items (path, key, version, result, prepared_at) VALUES (?, ?, ?, ?, ?)',
+                (path, key, CACHE_VERSION, blob, time.time()))
+
+    def get_rejection(self, path: str, key: str) -> Optional[Tuple[str, str]]:
+        """:return: (kind, reason) if the input was rejected by an earlier run, otherwise None."""
+        with self.lock:
+            return self.connection.execute(
+                'SELECT kind, reason FROM rejections WHERE path = ? AND key = ? AND version = ?',
+                (path, key, CACHE_VERSION)).fetchone()
+
+    def reject(self, path: str, key: str, kind: str, reason: str):
+        """Store why the input was rejected. Older rows for the same path are replaced."""
+        with self.lock, self.connection:
+            self.forget(path)
+            self.connection.execute(
+                'INSERT INTO rejections (path, key, version, kind, reason, rejected_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (path, key, CACHE_VERSION, kind, reason, time.time()))
+
+    def forget(self, path: str):
+        """Remove everything about path, inside a transaction holding the lock."""
+        self.connection.execute('DELETE FROM items WHERE path = ?', (path,))
+        self.connection.execute('DELETE FROM rejections WHERE path = ?', (path,))
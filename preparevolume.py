@@ -6,10 +6,23 @@
 # ^ See FInfo and FXInfo
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import posixpath
+import queue
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 import traceback
-from typing import Dict, Tuple, Union, Optional
+from typing import Callable, Deque, Dict, List, Tuple, Union, Optional
 
 import machfs
 import rsrcfork
@@ -20,18 +33,51 @@ import appledouble
 import applicationutil
 import diskcopyimage
 import disk
+import extractpack
+import preparecache
+import scratchspace
+import throttle
 
 DEFAULT_BLOCK_TARGET = int((1024 * 1024 * 1024 * 1) / 512)
 
+# Files over this are filtered out, along with whatever contains them. TODO: MAKE THIS TUNABLE
+MAX_FILE_SIZE = 1024 * 1024 * 5  # 5 MiB
+
+# Suffix of downloads still in progress, see macftp.py
+PARTIAL_DOWNLOAD_SUFFIX = '.part'
+
 argparser = argparse.ArgumentParser()
 argparser.add_argument('dl_folder')
 argparser.add_argument('sit_dir')
 argparser.add_argument('--target-blocks', type=int, default=DEFAULT_BLOCK_TARGET, help=f'Target size in 512 byte blocks. Default is {DEFAULT_BLOCK_TARGET} (1GiB)')
 argparser.add_argument('--volume-start-index', type=int, default=0)
 argparser.add_argument('--hfs-internals-ratio', type=float, default=0.85)
+argparser.add_argument('--jobs', '-j', type=int, default=1, help='Number of items to import and parse in parallel, in separate processes. Default is 1')
+argparser.add_argument('--extract-jobs', type=int, default=2, help='Number of archives to extract at once, each by its own unar process. Raise it for collections of many small archives, where starting unar takes longer than extracting. Default is 2')
+argparser.add_argument('--no-lsar', action='store_true', help='Extract every archive, without listing it with lsar first to drop the ones that would be filtered out')
+argparser.add_argument('--lsar-min-size', type=throttle.parse_rate, default=256 * 1024, help='Size below which archives are extracted without being listed first, e.g. 1M. Default is 256K')
+argparser.add_argument('--classify-jobs', type=int, default=1, help='Number of items to check for non-68k applications at once. Default is 1')
+argparser.add_argument('--queue-size', type=int, default=4, help='Items waiting in front of each stage before the stage feeding it has to wait. Default is 4')
+argparser.add_argument('--cache', default='prepared.db', help='Database of prepared items, reused for inputs that have not changed. Default is prepared.db')
+argparser.add_argument('--no-cache', action='store_true', help='Prepare every item from scratch, without reading or writing the cache')
+argparser.add_argument('--recheck-rejected', action='store_true', help='Prepare inputs that were filtered out or failed in an earlier run again, instead of skipping them')
+argparser.add_argument('--cache-key', choices=(preparecache.KEY_MTIME, preparecache.KEY_HASH), default=preparecache.KEY_MTIME,
+                       help='Tell whether an input changed by its size and modification time, or by hashing it. Default is mtime')
+argparser.add_argument('--extracted-format', choices=('loose', 'packed', 'lzma'), default='packed',
+                       help='Keep extracted archives in sit_dir as loose files, or as one pack per archive, optionally lzma compressed. Default is packed')
+argparser.add_argument('--scratch-budget', type=throttle.parse_rate,
+                       help='Space the archives extracted to sit_dir may take up, e.g. 20G. The least recently used ones are removed to stay below it. Default is unlimited')
+argparser.add_argument('--scratch-tmpfs', action='store_true', help=f'Extract archives to a temporary directory in {scratchspace.TMPFS_DIR} instead of sit_dir, removed when done')
 argparser.add_argument('--verbose', '-v', action='store_true')
 
-args = argparser.parse_args()
+# Set by parse_args(), either from the command line or by a script driving this module (see macftp.py --prepare).
+args: argparse.Namespace = None
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    global args
+    args = argparser.parse_args(argv)
+    return args
 
 
 class FilterException(Exception):
@@ -42,6 +88,10 @@ class PreparationIssue(Exception):
     pass
 
 
+HFS_FOLDER_NAME_LENGTH = 17
+HFS_FILE_NAME_LENGTH = 31
+
+
 def sanitize_hfs_name(name: bytes, is_folder: bool) -> bytes:
     if len(name) < 1:
         raise ValueError('Invalid empty hfs name')
@@ -49,19 +99,20 @@ def sanitize_hfs_name(name: bytes, is_folder: bool) -> bytes:
 
     val = name.replace(b':', b'?')
     if is_folder:
-        return val[:17]
+        return val[:HFS_FOLDER_NAME_LENGTH]
     else:
-        return val[:31]
+        return val[:HFS_FILE_NAME_LENGTH]
 
 
 def sanitize_hfs_name_str(name: str, is_folder: bool) -> bytes:
     return sanitize_hfs_name(name.encode('mac_roman', errors='replace'), is_folder=is_folder)
 
 
-def get_hfs_file_size(file: machfs.File) -> int:
-    def block_align(size: int) -> int:
-        return (int(size / 512) + (1 if size % 512 != 0 else 0)) * 512
+def block_align(size: int) -> int:
+    return (int(size / 512) + (1 if size % 512 != 0 else 0)) * 512
 
+
+def get_hfs_file_size(file: machfs.File) -> int:
     # Guessing 1K of Filesystem Junk for each file
     return block_align(len(file.data)) + block_align(len(file.rsrc))  # + 1024
 
@@ -91,6 +142,13 @@ def add_disk_data(containing_folder: AbstractFolder, path: str, data: bytes) ->
 
 
 def add_dsk(path: str) -> Tuple[machfs.Folder, bytes, int]:
+    with open(path, 'rb') as f:
+        flat = f.read()
+
+    return add_dsk_data(path, flat)
+
+
+def add_dsk_data(path: str, flat: bytes) -> Tuple[machfs.Folder, bytes, int]:
     if args.verbose:
         print(f'* Adding DSK image at {path}')
 
@@ -99,23 +157,24 @@ def add_dsk(path: str) -> Tuple[machfs.Folder, bytes, int]:
     dsk_folder = machfs.Folder()
     sanitized_folder_name = sanitize_hfs_name_str(folder_name, is_folder=True)
 
-    with open(path, 'rb') as f:
-        flat = f.read()
-
     return dsk_folder, sanitized_folder_name, add_disk_data(dsk_folder, path, flat)
 
 
 def add_img(path: str) -> Tuple[machfs.Folder, bytes, int]:
+    with open(path, 'rb') as f:
+        return add_img_file(path, f)
+
+
+def add_img_file(path: str, f) -> Tuple[machfs.Folder, bytes, int]:
     if args.verbose:
         print(f'* Adding DiskCopy image at {path}')
 
     header = diskcopyimage.DiskCopyImageHeader()
-    with open(path, 'rb') as f:
-        f.readinto(header)
-        try:
-            data = header.read_data(f)
-        except ValueError as e:
-            raise PreparationIssue(f'Error reading DiskCopy file at {path}: {e}')
+    f.readinto(header)
+    try:
+        data = header.read_data(f)
+    except ValueError as e:
+        raise PreparationIssue(f'Error reading DiskCopy file at {path}: {e}')
 
     disk_folder = machfs.Folder()
     folder_name = header.image_name
@@ -165,7 +224,7 @@ def add_file(path: str) -> Optional[Tuple[Union[machfs.Folder, machfs.File], byt
     if has_data_file:
         with open(path, 'rb') as f:
             size = f.seek(0, 2)
-            if size > 1024 * 1024 * 5:  # >5 MiB, TODO: MAKE THIS TUNABLE
+            if size > MAX_FILE_SIZE:
                 raise FilterException('Contains a file that is greater than 5 MiB')
             f.seek(0)
             file.data = f.read()
@@ -193,14 +252,10 @@ def add_file(path: str) -> Optional[Tuple[Union[machfs.Folder, machfs.File], byt
                 file.x = finder_entry.data.fdLocation.x
                 file.y = finder_entry.data.fdLocation.y
 
-            try:
-                supported_archs = applicationutil.get_supported_archs(file.rsrc)
-            except rsrcfork.api.InvalidResourceFileError:
-                print(f'Warning: Unable to parse resource fork from AppleDouble file at {rsrc_path}')
-                supported_archs = []
-
-            if len(supported_archs) > 0 and applicationutil.ARCH_68K not in supported_archs:
-                raise FilterException('Found a non-68k executable.')
+            if getattr(deferred, 'arch_checks', None) is not None:
+                deferred.arch_checks.append((file, rsrc_path))
+            else:
+                check_archs(file, rsrc_path)
 
     if args.verbose:
         print(f'* Adding file at path {path}')
@@ -210,6 +265,21 @@ def add_file(path: str) -> Optional[Tuple[Union[machfs.Folder, machfs.File], byt
     return file, sanitized_name, get_hfs_file_size(file)
 
 
+# Set arch_checks to a list to collect the files check_archs() should be run on, instead of checking them right away.
+deferred = threading.local()
+
+
+def check_archs(file: machfs.File, rsrc_path: str):
+    try:
+        supported_archs = applicationutil.get_supported_archs(file.rsrc)
+    except rsrcfork.api.InvalidResourceFileError:
+        print(f'Warning: Unable to parse resource fork from AppleDouble file at {rsrc_path}')
+        supported_archs = []
+
+    if len(supported_archs) > 0 and applicationutil.ARCH_68K not in supported_archs:
+        raise FilterException('Found a non-68k executable.')
+
+
 def add_files(root: AbstractFolder, path: str) -> int:
     path_map: Dict[str, AbstractFolder] = {path: root}
 
@@ -242,25 +312,334 @@ def add_files(root: AbstractFolder, path: str) -> int:
 
 
 def add_sit(path: str) -> Tuple[machfs.Folder, bytes, int]:
+    return add_extracted(path, extract_sit(path))
+
+
+def extract_sit(path: str) -> str:
+    """:return: The directory or pack the archive was extracted to."""
+    key = source_key(path, None)
+    if should_list(path, os.path.getsize(path), key):
+        list_archive(path, None)
+    return unpack_archive(path, None, key)
+
+
+def source_key(path: str, data: Optional[bytes]) -> str:
+    """:return: The key identifying the contents of an input, as the cache and packs know it."""
+    if data is not None:
+        return preparecache.data_key(data)
+    return preparecache.input_key(path, args.cache_key)
+
+
+def extraction_dir(path: str) -> str:
+    """
+    :return: The folder in sit_dir the archive at path is extracted to. Archives with the same name in different
+    folders each get their own.
+    """
     _, filename = os.path.split(path)
     folder_name, _ = os.path.splitext(filename)
-    output_dir = os.path.join(args.sit_dir, folder_name)
-    result = subprocess.run([
-        'unar',
-        '-o', args.sit_dir,
-        '-s',  # Skip files which exist
-        '-d',  # Force directory,
+    path_hash = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:12]
+    return os.path.join(args.sit_dir, f'{folder_name}-{path_hash}')
+
+
+def should_list(path: str, size: int, key: str) -> bool:
+    """:return: Whether to check the archive's listing before extracting it, see check_listing()."""
+    if args.no_lsar or size < args.lsar_min_size:
+        return False
+    return not existing_pack(extraction_dir(path), key)
+
+
+def list_archive(path: str, data: Optional[bytes]) -> Optional[int]:
+    """
+    List an archive with lsar and check the listing, raising FilterException if the archive is certain to be rejected.
+    :param data: The contents of the archive if it is only in memory, otherwise it is read from path.
+    :return: Estimated bytes the archive will take up in a volume, or None if lsar couldn't list it, in which case it is
+    left to unar to fail.
+    """
+    command = [
+        'lsar',
+        '-j',  # JSON
         '-p', '',  # Always use blank password
-        '-q',  # Quiet
-        '-forks', 'visible',
-        path
-    ])
+    ]
+    if data is None:
+        result = subprocess.run(command + [path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    else:
+        _, filename = os.path.split(path)
+        with memory_file(filename, data) as (archive_path, fds):
+            result = subprocess.run(command + [archive_path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    pass_fds=fds)
+    if result.returncode != 0:
+        return None
+    try:
+        contents = json.loads(result.stdout)['lsarContents']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+    estimated_bytes = check_listing(contents)
+    if args.verbose:
+        print(f'* Listed {path}, ~{sizeof_fmt(estimated_bytes)} once extracted')
+    return estimated_bytes
+
+
+def check_listing(contents: List[dict]) -> int:
+    """
+    Apply the rules add_files and add_file follow for an extracted archive to its lsar listing instead, raising
+    FilterException for .app folders, DMGs and files over 5 MiB.
+    :param contents: lsarContents from lsar -j.
+    :return: Estimated bytes the archive's files will take up in a volume, like get_hfs_file_size() counts them, with
+    nested archives and disk images counted as they are.
+    """
+    # [data fork size, resource fork size] by name.
+    forks: Dict[str, List[int]] = {}
+
+    for entry in contents:
+        name = entry.get('XADFileName', '')
+        parts = [part for part in name.split('/') if part]
+        is_directory = bool(entry.get('XADIsDirectory'))
+
+        for dirname in (parts if is_directory else parts[:-1]):
+            _, dirname_ext = os.path.splitext(dirname)
+            if dirname_ext == '.app':
+                raise FilterException(".app directory detected")
+        if is_directory or not parts:
+            continue
+
+        filename = parts[-1]
+        if filename == '.DS_Store':
+            continue
+        size = entry.get('XADFileSize', 0)
+        if entry.get('XADIsResourceFork'):
+            forks.setdefault(name, [0, 0])[1] = size
+            continue
+        forks.setdefault(name, [0, 0])[0] = size
+
+        _, ext = os.path.splitext(filename)
+        if ext == '.dmg':
+            raise FilterException('Contains an OSX DMG')
+        if ext not in ('.img', '.image', '.sit', '.dsk', '.rsrc') and size > MAX_FILE_SIZE:
+            raise FilterException('Contains a file that is greater than 5 MiB')
+
+    return sum(block_align(data_size) + block_align(rsrc_size) for data_size, rsrc_size in forks.values())
+
+
+def unpack_archive(path: str, data: Optional[bytes], key: str) -> str:
+    """
+    Extract an archive with unar to its folder in sit_dir, unless it was already extracted and packed.
+    :param data: The contents of the archive if it is only in memory, otherwise it is read from path.
+    :param key: The archive's source_key(), stored in its pack.
+    :return: The directory or pack the archive was extracted to.
+    """
+    _, filename = os.path.split(path)
+    output_dir = extraction_dir(path)
+    if existing_pack(output_dir, key):
+        return output_dir + extractpack.PACK_SUFFIX
+
+    # Whatever is left there is from an older version of the archive, or an extraction that was cut short.
+    shutil.rmtree(output_dir, ignore_errors=True)
+    with contextlib.ExitStack() as stack:
+        if data is None:
+            archive_path = path
+            fds = ()
+        else:
+            archive_path, fds = stack.enter_context(memory_file(filename, data))
+        # unar would name the directory it forces after the archive path, so name it here instead.
+        result = subprocess.run([
+            'unar',
+            '-o', output_dir,
+            '-s',  # Skip files which exist
+            '-D',  # Never create a directory, output_dir is already the archive's own
+            '-p', '',  # Always use blank password
+            '-q',  # Quiet
+            '-forks', 'visible',
+            archive_path
+        ], pass_fds=fds)
     if result.returncode != 0:
         raise PreparationIssue(f'There was an error extracting {path}')
+    return pack_extracted(output_dir, key)
+
 
+def existing_pack(output_dir: str, key: str) -> bool:
+    """
+    :return: Whether the archive with the given key was already extracted and packed to output_dir, so unar doesn't
+    have to run again.
+    """
+    pack_path = output_dir + extractpack.PACK_SUFFIX
+    if args.extracted_format == 'loose':
+        return False
+    try:
+        with extractpack.Pack(pack_path) as pack:
+            if pack.source != key:
+                return False
+    except (FileNotFoundError, extractpack.InvalidPack):
+        return False
+    scratchspace.touch(pack_path)
+    return True
+
+
+def pack_extracted(output_dir: str, key: str) -> str:
+    """
+    Replace the tree unar extracted to output_dir with a pack, unless --extracted-format is loose.
+    :return: The directory or pack the archive is now extracted to.
+    """
+    if args.extracted_format == 'loose':
+        scratchspace.touch(output_dir)
+        return output_dir
+    pack_path = output_dir + extractpack.PACK_SUFFIX
+    extractpack.write_pack(output_dir, pack_path, compress=args.extracted_format == 'lzma', source=key)
+    shutil.rmtree(output_dir)
+    return pack_path
+
+
+def add_extracted(path: str, extracted: str) -> Tuple[machfs.Folder, bytes, int]:
+    """Add the contents of the archive at path, already extracted to the directory or pack at extracted."""
+    _, filename = os.path.split(path)
+    folder_name, _ = os.path.splitext(filename)
     folder = machfs.Folder()
     folder_name = sanitize_hfs_name_str(folder_name, is_folder=True)
-    return folder, folder_name, add_files(folder, output_dir)
+    if extracted.endswith(extractpack.PACK_SUFFIX):
+        return folder, folder_name, add_packed(folder, extracted)
+    return folder, folder_name, add_files(folder, extracted)
+
+
+def add_packed(root: AbstractFolder, pack_path: str) -> int:
+    """
+    Like add_files, for an archive extracted into a pack. Files are named and reported by where they would have been
+    extracted to, and nested archives and disk images are added from memory.
+    """
+    output_dir = pack_path[:-len(extractpack.PACK_SUFFIX)]
+    folders: Dict[str, AbstractFolder] = {'': root}
+
+    total_bytes = 0
+
+    with extractpack.Pack(pack_path) as pack:
+        for entry in pack.entries:
+            if 'dir' in entry:
+                parent, dirname = posixpath.split(entry['dir'])
+                _, dirname_ext = os.path.splitext(dirname)
+                if dirname_ext == '.app':
+                    raise FilterException(".app directory detected")
+
+                hfs_dir = machfs.Folder()
+                folders[parent][sanitize_hfs_name_str(dirname, is_folder=True)] = hfs_dir
+                folders[entry['dir']] = hfs_dir
+                continue
+
+            parent, filename = posixpath.split(entry['file'])
+            result = add_packed_file(pack, entry, os.path.join(output_dir, *entry['file'].split('/')))
+            if not result:
+                continue
+            file, hfs_filename, file_bytes = result
+            folders[parent][hfs_filename] = file
+            total_bytes += file_bytes
+
+    return total_bytes
+
+
+def add_packed_file(pack: extractpack.Pack, entry: dict,
+                    path: str) -> Optional[Tuple[Union[machfs.Folder, machfs.File], bytes, int]]:
+    """add_file for a file in a pack. path is where the file would have been extracted to."""
+    _, filename = os.path.split(path)
+    base_filename, ext = os.path.splitext(filename)
+    has_data_file = entry['data'] is not None
+
+    if filename == '.DS_Store':
+        return None
+
+    if ext == '.dmg':
+        raise FilterException('Contains an OSX DMG')
+
+    if has_data_file and ext in ('.img', '.image', '.sit', '.dsk'):
+        return add_data(path, pack.read(entry['data']))
+
+    file = machfs.File()
+
+    if has_data_file:
+        if entry['data'][2] > MAX_FILE_SIZE:
+            raise FilterException('Contains a file that is greater than 5 MiB')
+        file.data = pack.read(entry['data'])
+        rsrc_path = path + '.rsrc'
+    else:
+        rsrc_path = path
+
+    if entry['double']:
+        if entry['rsrc'] is not None:
+            file.rsrc = pack.read(entry['rsrc'])
+
+        if entry['finder'] is not None:
+            file_type, creator, flags, x, y = entry['finder']
+            file.type = bytes.fromhex(file_type)
+            file.creator = bytes.fromhex(creator)
+            file.flags = flags
+            file.x = x
+            file.y = y
+
+        if getattr(deferred, 'arch_checks', None) is not None:
+            deferred.arch_checks.append((file, rsrc_path))
+        else:
+            check_archs(file, rsrc_path)
+
+    if args.verbose:
+        print(f'* Adding file at path {path}')
+
+    hfs_filename = filename if has_data_file else base_filename
+    sanitized_name = sanitize_hfs_name_str(hfs_filename, is_folder=False)
+    return file, sanitized_name, get_hfs_file_size(file)
+
+
+@contextlib.contextmanager
+def memory_file(name: str, data: bytes):
+    """
+    Make data readable by a child process without writing it to disk, using an anonymous in-memory file where the
+    platform has them and a temporary file otherwise.
+    :return: The path the child should open, and the file descriptors it needs to inherit for that path to work.
+    """
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create(name)
+        try:
+            with open(fd, 'wb', closefd=False) as f:
+                f.write(data)
+            yield f'/proc/self/fd/{fd}', (fd,)
+        finally:
+            os.close(fd)
+    else:
+        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(name)[1]) as f:
+            f.write(data)
+            f.flush()
+            yield f.name, ()
+
+
+def add_sit_data(path: str, data: bytes) -> Tuple[machfs.Folder, bytes, int]:
+    """Like add_sit, but for an archive that is only in memory. path is only used for naming."""
+    return add_extracted(path, extract_sit_data(path, data))
+
+
+def extract_sit_data(path: str, data: bytes) -> str:
+    key = source_key(path, data)
+    if should_list(path, len(data), key):
+        list_archive(path, data)
+    return unpack_archive(path, data, key)
+
+
+def add_data(path: str, data: bytes) -> Optional[Tuple[Union[machfs.Folder, machfs.File], bytes, int]]:
+    """Like add_file, for a downloaded file that was handed over in memory instead of being saved at path."""
+    _, filename = os.path.split(path)
+    _, ext = os.path.splitext(filename)
+
+    if ext == '.dmg':
+        raise FilterException('Contains an OSX DMG')
+    if ext == '.img' or ext == '.image':
+        return add_img_file(path, io.BytesIO(data))
+    if ext == '.sit':
+        return add_sit_data(path, data)
+    if ext == '.dsk':
+        return add_dsk_data(path, data)
+
+    if len(data) > MAX_FILE_SIZE:
+        raise FilterException('Contains a file that is greater than 5 MiB')
+    if args.verbose:
+        print(f'* Adding file at path {path}')
+    file = machfs.File()
+    file.data = data
+    return file, sanitize_hfs_name_str(filename, is_folder=False), get_hfs_file_size(file)
 
 
 def sizeof_fmt(num, suffix='B'):
@@ -276,73 +655,478 @@ class CoolBar(Bar):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.bytes_taken = 0
+        self.preparer: Optional[Preparer] = None
 
     @property
     def human_readable_bytes(self):
         return sizeof_fmt(self.bytes_taken)
 
+    @property
+    def queues(self):
+        return self.preparer.depths if self.preparer is not None else ''
+
 
 def to_blocks(byte_count: int) -> int:
     return int(byte_count / 512) + (1 if byte_count % 512 != 0 else 0)
 
 
 class VolumeManager:
-    def __init__(self, start_index: int):
+    def __init__(self, start_index: int, target_size: int):
         self.volume_index = start_index
+        self.target_size = target_size
         self.bytes_taken = 0
         self.volume = machfs.Volume()
+        # Called with the index and contents of each finished volume.
+        self.writer: Callable[[int, machfs.Volume], None] = write_volume_file
+
+    def add(self, name: bytes, item: Union[machfs.Folder, machfs.File], bytes_taken: int):
+        # If this new entry would cause us to go over, write the current volume out and start a new volume.
+        if self.bytes_taken + bytes_taken > self.target_size:
+            print('Reached target size, writing a volume.')
+            self.write_volume()
+
+        self.volume[self.unique_name(name, isinstance(item, machfs.Folder))] = item
+        self.bytes_taken += bytes_taken
+
+    def unique_name(self, name: bytes, is_folder: bool) -> bytes:
+        """
+        :return: name, or if the volume already has an item by that name (e.g. Foo.sit from two directories), name with
+        a number appended to tell them apart.
+        """
+        unique = name
+        number = 2
+        while unique in self.volume:
+            suffix = f' {number}'.encode('mac_roman')
+            limit = HFS_FOLDER_NAME_LENGTH if is_folder else HFS_FILE_NAME_LENGTH
+            unique = name[:limit - len(suffix)] + suffix
+            number += 1
+        if unique != name:
+            print(f'Naming {name.decode("mac_roman")} {unique.decode("mac_roman")}, as the volume already has an item by that name')
+        return unique
 
     def write_volume(self):
         self.volume.name = f'Pimp My Plus #{self.volume_index}'
-
-        volume_output_path = f'collection.{self.volume_index}.scsi'
-        print(f'Writing Volume to {volume_output_path} with {args.target_blocks} blocks')
-        with open(volume_output_path, 'wb') as f:
-            disk.create_bootable_disk(f, self.volume, args.target_blocks)
+        self.writer(self.volume_index, self.volume)
 
         self.volume_index += 1
         self.volume = machfs.Volume()
         self.bytes_taken = 0
 
 
-files = os.listdir(args.dl_folder)
-files.sort(key=str.casefold)
-volume_manager = VolumeManager(args.volume_start_index)
+def write_volume_file(volume_index: int, volume: machfs.Volume):
+    volume_output_path = f'collection.{volume_index}.scsi'
+    print(f'Writing Volume to {volume_output_path} with {args.target_blocks} blocks')
+    with open(volume_output_path, 'wb') as f:
+        disk.create_bootable_disk(f, volume, args.target_blocks)
 
-# Extra blocks are taken by the filesystem when writing the volume.
-# In the future, we could be more smart about this (Do bookkeeping when adding files to the volume, might require modifying machfs library)
-# For now, just cheese it and calculate usable space using a ratio of file data to filesystem data.
-target_blocks_per_volume = int(args.target_blocks * args.hfs_internals_ratio) - 96
-target_size = target_blocks_per_volume * 512
 
+def create_volume_manager() -> VolumeManager:
+    # Extra blocks are taken by the filesystem when writing the volume.
+    # In the future, we could be more smart about this (Do bookkeeping when adding files to the volume, might require modifying machfs library)
+    # For now, just cheese it and calculate usable space using a ratio of file data to filesystem data.
+    target_blocks_per_volume = int(args.target_blocks * args.hfs_internals_ratio) - 96
+    target_size = target_blocks_per_volume * 512
+    return VolumeManager(args.volume_start_index, target_size)
 
-with CoolBar(max=len(files), suffix='%(percent)d%% -- %(index)d / %(max)d -- ~%(human_readable_bytes)s') as progress:
-    progress.start()
 
-    for file in files:
-        path = os.path.join(args.dl_folder, file)
-        result = None
-        try:
+def import_item(path: str, data: Optional[bytes] = None, extracted_dir: Optional[str] = None):
+    """
+    Import and parse one top-level item, leaving out the architecture checks.
+    :param data: The contents of the file if it is only in memory, otherwise it is read from path.
+    :param extracted_dir: Where the archive at path has already been extracted to.
+    :return: The result of add_file, and the (file, resource fork path) pairs check_archs() still has to be run on.
+    """
+    deferred.arch_checks = []
+    try:
+        if extracted_dir is not None:
+            result = add_extracted(path, extracted_dir)
+        elif data is not None:
+            result = add_data(path, data)
+        else:
             result = add_file(path)
-        except (PreparationIssue, FilterException) as e:
-            print(e)
-
-        if result:
-            result_file, result_filename, bytes_taken = result
-
-            # If this new entry would cause us to go over, write the current volume out and start a new volume.
-            if volume_manager.bytes_taken + bytes_taken > target_size:
-                print('Reached target size, writing a volume.')
-                volume_manager.write_volume()
-                progress.bytes_taken = 0
+        return result, deferred.arch_checks
+    finally:
+        deferred.arch_checks = None
 
-            volume_manager.volume[result_filename] = result_file
-            print(f'\n* Added {file} (~{sizeof_fmt(bytes_taken)})')
-            progress.bytes_taken += bytes_taken
-            volume_manager.bytes_taken += bytes_taken
 
-        progress.next()
+def check_rsrc_archs(rsrc: bytes, rsrc_path: str):
+    """check_archs() for just a resource fork, so it can be sent to another process."""
+    file = machfs.File()
+    file.rsrc = rsrc
+    check_archs(file, rsrc_path)
+
+
+def commit_item(volume_manager: VolumeManager, path: str,
+                result: Optional[Tuple[Union[machfs.Folder, machfs.File], bytes, int]]):
+    if result:
+        result_file, result_filename, bytes_taken = result
+        volume_manager.add(result_filename, result_file, bytes_taken)
+        print(f'\n* Added {os.path.basename(path)} (~{sizeof_fmt(bytes_taken)})')
+
+
+def init_worker(worker_args: argparse.Namespace):
+    global args
+    args = worker_args
+
+
+class PipelineItem(object):
+    """A top-level item on its way through the Preparer's stages."""
+
+    def __init__(self, index: int, path: str, data: Optional[bytes]):
+        self.index = index
+        self.path = path
+        self.data = data
+        self.extracted_dir: Optional[str] = None
+        self.result: Optional[Tuple[Union[machfs.Folder, machfs.File], bytes, int]] = None
+        self.arch_checks: List[Tuple[machfs.File, str]] = []
+        # Identifies the input in the cache, and whether its result came from there.
+        self.key: Optional[str] = None
+        self.cached = False
+        self.rejected_before = False
+        # From the archive's lsar listing, if it was listed.
+        self.estimated_bytes: Optional[int] = None
+
+        # Set by the first stage that fails on the item, the later stages only pass it on.
+        self.error: Optional[Exception] = None
+        self.error_trace = ''
+
+    def fail(self, error: Exception):
+        """Record that preparing the item failed, from the except block handling error."""
+        self.error = error
+        self.error_trace = traceback.format_exc()
+
+
+class Stage(object):
+    """
+    Worker threads taking entries from a bounded queue. When the queue is full, put() blocks, so a stage that falls
+    behind holds up the stage feeding it instead of letting entries pile up in memory.
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int, process: Callable,
+                 downstream: Optional['Stage'] = None, skip_failed: bool = True, fatal: bool = False):
+        """
+        :param fatal: The entries aren't PipelineItems that can fail on their own. Instead the first exception is kept
+        in error, and every entry after it is dropped.
+        """
+        self.name = name
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.process = process
+        # Every entry is passed on once processed, including failed ones, as pack has to see all of them.
+        self.downstream = downstream
+        self.skip_failed = skip_failed
+        self.fatal = fatal
+        self.error: Optional[Exception] = None
+
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        # Time the stage feeding this one spent waiting for room in the queue.
+        self.held_up = 0.0
+
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(max(workers, 1))]
+        for thread in self.threads:
+            thread.start()
+
+    # How long the current worker thread has waited in put() on the stage after it, not counted as busy.
+    waiting = threading.local()
+
+    def put(self, entry):
+        start = time.monotonic()
+        self.queue.put(entry)
+        waited = time.monotonic() - start
+        Stage.waiting.seconds = getattr(Stage.waiting, 'seconds', 0.0) + waited
+        with self.lock:
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+            self.held_up += waited
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                break
+
+            start = time.monotonic()
+            Stage.waiting.seconds = 0.0
+            if self.fatal:
+                if self.error is None:
+                    try:
+                        self.process(entry)
+                    except Exception as e:
+                        self.error = e
+            elif not (self.skip_failed and entry.error is not None):
+                try:
+                    self.process(entry)
+                except Exception as e:
+                    entry.fail(e)
+            if self.downstream is not None:
+                self.downstream.put(entry)
+            with self.lock:
+                self.items += 1
+                self.busy += time.monotonic() - start - Stage.waiting.seconds
+
+    def close(self):
+        """Wait for every queued entry to be processed."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
 
-    volume_manager.write_volume()
+    @property
+    def depth(self) -> str:
+        return f'{self.name} {self.queue.qsize()}/{self.queue.maxsize}'
+
+    def summary(self) -> str:
+        with self.lock:
+            return (f'{self.name}: {len(self.threads)} workers, {self.items} items, {self.busy:.1f}s busy, '
+                    f'queue peaked at {self.max_depth}/{self.queue.maxsize}, held up the stage before for '
+                    f'{self.held_up:.1f}s')
+
+
+class Preparer(object):
+    """
+    Prepares items in stages connected by bounded queues, each stage with its own workers:
+
+        scan      whoever calls submit(), e.g. main() listing dl_folder
+        extract   looking items up in the cache (see preparecache.py), then unar runs for .sit archives (--extract-jobs),
+                  keeping sit_dir within --scratch-budget (see scratchspace.py)
+        import    reading and parsing files, forks and disk images into HFS trees (--jobs processes)
+        classify  architecture checks of resource forks, and the verdict on each item (--classify-jobs)
+        pack      adding items to the volume manager, in the order they were submitted
+        write     writing finished volumes, while the next one is packed
+
+    Packing in submission order means running in parallel never changes which volume an item ends up in. An item that
+    fails unexpectedly is reported and skipped. A volume that fails to write stops the run, see finish().
+    """
+
+    def __init__(self, volume_manager: VolumeManager, on_commit: Optional[Callable[[], None]] = None):
+        self.volume_manager = volume_manager
+        self.on_commit = on_commit
+
+        self.tmpfs_dir = None
+        if args.scratch_tmpfs:
+            # Before the pool is started, so its processes extract there too.
+            self.tmpfs_dir = tempfile.mkdtemp(prefix='preparevolume-', dir=scratchspace.TMPFS_DIR)
+            args.sit_dir = self.tmpfs_dir
+        self.scratch = scratchspace.ScratchSpace(args.sit_dir, args.scratch_budget)
+        # When each item that hasn't been packed yet was submitted, oldest first.
+        self.started: Deque[float] = collections.deque()
+
+        self.pool = None
+        if args.jobs > 1:
+            # Not forked, as macftp.py runs this next to its download threads.
+            self.pool = concurrent.futures.ProcessPoolExecutor(args.jobs, mp_context=multiprocessing.get_context('spawn'),
+                                                               initializer=init_worker, initargs=(args,))
+
+        self.cache = None if args.no_cache else preparecache.PreparedCache(args.cache)
+        self.cache_hits = 0
+        self.skipped_rejections = 0
+        # lsar estimates of the archives that made it into a volume, and the bytes they ended up taking.
+        self.estimated_bytes = 0
+        self.estimated_actual_bytes = 0
+
+        self.next_index = 0
+        self.next_commit = 0
+        # Items that finished ahead of an earlier one, by index.
+        self.finished: Dict[int, PipelineItem] = {}
+
+        # Finished volumes are big, so only one waits to be written.
+        self.write = Stage('write', 1, 1, lambda entry: write_volume_file(*entry), fatal=True)
+        self.pack = Stage('pack', 1, args.queue_size, self.pack_item, skip_failed=False)
+        self.classify = Stage('classify', args.classify_jobs, args.queue_size, self.classify_item, self.pack,
+                              skip_failed=False)
+        self.import_ = Stage('import', args.jobs, args.queue_size, self.import_item, self.classify)
+        self.extract = Stage('extract', args.extract_jobs, args.queue_size, self.extract_item, self.import_)
+        self.stages = [self.extract, self.import_, self.classify, self.pack, self.write]
+        volume_manager.writer = lambda volume_index, volume: self.write.put((volume_index, volume))
+
+        # Every submitted item is held somewhere until it is packed, including items waiting in pack for an earlier
+        # one, so limit how many there can be.
+        self.in_flight = threading.Semaphore(sum(len(stage.threads) + stage.queue.maxsize for stage in self.stages[:4]))
+
+    def submit(self, path: str, data: Optional[bytes] = None):
+        """Queue an item for preparation, waiting while the pipeline is full."""
+        if self.write.error is not None:
+            # The item could never be written, finish() raises the error.
+            return
+        self.in_flight.acquire()
+        self.started.append(time.time())
+        item = PipelineItem(self.next_index, path, data)
+        self.next_index += 1
+        self.extract.put(item)
+
+    def make_room(self, needed: int = 0):
+        """
+        Remove extracted archives over --scratch-budget that no item being prepared can still need.
+        :param needed: Bytes about to be extracted, to make room for.
+        """
+        try:
+            in_use_since = self.started[0]
+        except IndexError:
+            in_use_since = None
+        self.scratch.enforce(in_use_since, needed)
+
+    def run_in_pool(self, function, *function_args):
+        if self.pool is None:
+            return function(*function_args)
+        return self.pool.submit(function, *function_args).result()
+
+    def look_up(self, item: PipelineItem) -> bool:
+        """:return: Whether the item's result, or its rejection by an earlier run, was found in the cache."""
+        item.key = source_key(item.path, item.data)
+
+        rejection = None if args.recheck_rejected else self.cache.get_rejection(item.path, item.key)
+        if rejection is not None:
+            kind, reason = rejection
+            exception_class = FilterException if kind == preparecache.REJECTION_FILTERED else PreparationIssue
+            item.error = exception_class(reason)
+            item.rejected_before = True
+            if args.verbose:
+                print(f'* Skipping {item.path}, it was rejected before')
+        else:
+            found, item.result = self.cache.get(item.path, item.key)
+            if not found:
+                return False
+            if args.verbose:
+                print(f'* Using the cached result for {item.path}')
+
+        item.cached = True
+        item.data = None
+        return True
+
+    def extract_item(self, item: PipelineItem):
+        if self.cache is not None and self.look_up(item):
+            return
+
+        _, ext = os.path.splitext(item.path)
+        if ext == '.sit':
+            if item.key is None:
+                item.key = source_key(item.path, item.data)
+            size = len(item.data) if item.data is not None else os.path.getsize(item.path)
+            if should_list(item.path, size, item.key):
+                item.estimated_bytes = list_archive(item.path, item.data)
+            self.make_room(item.estimated_bytes or 0)
+            item.extracted_dir = unpack_archive(item.path, item.data, item.key)
+            item.data = None
+            self.scratch.record(item.extracted_dir)
+
+    def import_item(self, item: PipelineItem):
+        if item.cached:
+            return
+        item.result, item.arch_checks = self.run_in_pool(import_item, item.path, item.data, item.extracted_dir)
+        item.data = None
+
+    def classify_item(self, item: PipelineItem):
+        try:
+            if item.error is None:
+                for file, rsrc_path in item.arch_checks:
+                    self.run_in_pool(check_rsrc_archs, file.rsrc, rsrc_path)
+        except Exception as e:
+            item.fail(e)
+        item.arch_checks = []
+
+        if self.cache is not None and not item.cached:
+            try:
+                if item.error is None:
+                    self.cache.put(item.path, item.key, item.result)
+                elif isinstance(item.error, FilterException):
+                    self.cache.reject(item.path, item.key, preparecache.REJECTION_FILTERED, str(item.error))
+                elif isinstance(item.error, PreparationIssue):
+                    self.cache.reject(item.path, item.key, preparecache.REJECTION_FAILED, str(item.error))
+            except Exception:
+                # The item itself is fine, it's only prepared again on the next run.
+                traceback.print_exc()
+                print(f'Unable to store {item.path} in {args.cache}, continuing without it.')
+
+        if isinstance(item.error, (PreparationIssue, FilterException)):
+            print(item.error)
+        elif item.error is not None:
+            print(item.error_trace, end='')
+            print(f'Error preparing {item.path}, skipping.')
+
+    def pack_item(self, item: PipelineItem):
+        self.finished[item.index] = item
+        while self.next_commit in self.finished:
+            item = self.finished.pop(self.next_commit)
+            self.next_commit += 1
+            if item.rejected_before:
+                self.skipped_rejections += 1
+            elif item.cached:
+                self.cache_hits += 1
+            if item.estimated_bytes is not None and item.error is None and item.result:
+                self.estimated_bytes += item.estimated_bytes
+                self.estimated_actual_bytes += item.result[2]
+            try:
+                if item.error is None and self.write.error is None:
+                    commit_item(self.volume_manager, item.path, item.result)
+            except Exception:
+                traceback.print_exc()
+                print(f'Error preparing {item.path}, skipping.')
+            finally:
+                self.started.popleft()
+                self.in_flight.release()
+            if self.on_commit is not None:
+                self.on_commit()
+        self.make_room()
 
-print('Done!')
+    @property
+    def depths(self) -> str:
+        return ', '.join(stage.depth for stage in self.stages)
+
+    def finish(self, write_empty: bool = False):
+        """
+        Wait for every submitted item to be packed, then write the last volume if it has anything in it. Raises the
+        error a volume failed to be written with, if any.
+        """
+        for stage in self.stages[:4]:
+            stage.close()
+        if self.volume_manager.bytes_taken > 0 or write_empty:
+            self.volume_manager.write_volume()
+        self.write.close()
+
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.cache is not None:
+            self.cache.close()
+            print(f'Reused {self.cache_hits} of {self.next_index} items from {args.cache}')
+            if self.skipped_rejections > 0:
+                print(f'Skipped {self.skipped_rejections} items rejected by an earlier run, use --recheck-rejected to try them again')
+        if self.scratch.evicted > 0:
+            print(f'Removed {self.scratch.evicted} extracted archives ({sizeof_fmt(self.scratch.evicted_bytes)}) to stay within the scratch budget')
+        if self.tmpfs_dir is not None:
+            shutil.rmtree(self.tmpfs_dir, ignore_errors=True)
+        if args.verbose:
+            if self.estimated_actual_bytes > 0:
+                print(f'lsar estimated {sizeof_fmt(self.estimated_bytes)} for archives that took up {sizeof_fmt(self.estimated_actual_bytes)}')
+            for stage in self.stages:
+                print(stage.summary())
+        if self.write.error is not None:
+            raise self.write.error
+
+
+def main():
+    parse_args()
+
+    files = [file for file in os.listdir(args.dl_folder) if not file.endswith(PARTIAL_DOWNLOAD_SUFFIX)]
+    files.sort(key=str.casefold)
+    volume_manager = create_volume_manager()
+
+    with CoolBar(max=len(files), suffix='%(percent)d%% -- %(index)d / %(max)d -- ~%(human_readable_bytes)s -- %(queues)s') as progress:
+        def committed():
+            progress.bytes_taken = volume_manager.bytes_taken
+            progress.next()
+
+        preparer = Preparer(volume_manager, committed)
+        progress.preparer = preparer
+        progress.start()
+
+        for file in files:
+            preparer.submit(os.path.join(args.dl_folder, file))
+
+        preparer.finish(write_empty=True)
+
+    print('Done!')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Keeps the archives extracted into a scratch directory (preparevolume's sit_dir) under a byte budget by removing the
+least recently used ones. Each archive is one entry in the directory, either a pack or a folder of loose files.
+
+Archives are marked as used by touching them (see touch()), so their modification time tells when they were last used,
+by this run or an earlier one. That also covers archives extracted by other processes, which only show up here when the
+directory is scanned again.
+"""
+
+import os
+import shutil
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# Where --scratch-tmpfs puts scratch space.
+TMPFS_DIR = '/dev/shm'
+
+# Seconds between scans of the directory for archives this process didn't record itself.
+RESCAN_INTERVAL = 30.0
+
+# Some filesystems keep modification times coarsely, so an archive used just after an item started could look older.
+MTIME_SLACK = 2.0
+
+
+def touch(path: str):
+    """Mark an extracted archive as used, so it is evicted last."""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def tree_size(path: str) -> int:
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def entry_size(path: str) -> Optional[Tuple[float, int]]:
+    """:return: When the archive at path was last used and how big it is, or None if it is gone."""
+    try:
+        stat = os.lstat(path)
+    except FileNotFoundError:
+        return None
+    if os.path.isdir(path):
+        return stat.st_mtime, tree_size(path)
+    return stat.st_mtime, stat.st_size
+
+
+class ScratchSpace(object):
+    def __init__(self, root: str, budget: Optional[int]):
+        """:param budget: Bytes the extracted archives may take up, None for no limit."""
+        self.root = root
+        self.budget = budget
+        self.lock = threading.Lock()
+
+        # Last use and size of each archive, by path.
+        self.entries: Dict[str, Tuple[float, int]] = {}
+        self.total = 0
+        self.scanned_at: Optional[float] = None
+
+        self.evicted = 0
+        self.evicted_bytes = 0
+
+    def scan(self):
+        """Rebuild the list of archives from the directory. Folders that haven't changed aren't measured again."""
+        entries = {}
+        if os.path.isdir(self.root):
+            for entry in os.scandir(self.root):
+                known = self.entries.get(entry.path)
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if known is not None and known[0] == stat.st_mtime:
+                        entries[entry.path] = known
+                    else:
+                        entries[entry.path] = stat.st_mtime, tree_size(entry.path)
+                else:
+                    entries[entry.path] = stat.st_mtime, stat.st_size
+
+        self.entries = entries
+        self.total = sum(size for _, size in entries.values())
+        self.scanned_at = time.monotonic()
+
+    def record(self, path: str):
+        """Note that the archive at path was just extracted or used."""
+        if self.budget is None:
+            return
+
+        measured = entry_size(path)
+        with self.lock:
+            _, previous_size = self.entries.pop(path, (0.0, 0))
+            self.total -= previous_size
+            if measured is not None:
+                self.entries[path] = measured
+                self.total += measured[1]
+
+    def enforce(self, in_use_since: Optional[float] = None, needed: int = 0):
+        """
+        Remove the least recently used archives until the rest fit in the budget.
+        :param in_use_since: time.time() from when the oldest item still being prepared started. Archives used since
+        then may still be needed, so are never removed.
+        :param needed: Bytes to leave room for on top of the archives already there.
+        """
+        if self.budget is None:
+            return
+
+        with self.lock:
+            if self.scanned_at is None or time.monotonic() - self.scanned_at > RESCAN_INTERVAL:
+                self.scan()
+            if self.total + needed <= self.budget:
+                return
+
+            for path, (last_used, size) in sorted(self.entries.items(), key=lambda entry: entry[1][0]):
+                if self.total + needed <= self.budget:
+                    break
+                if in_use_since is not None and last_used >= in_use_since - MTIME_SLACK:
+                    break
+
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                del self.entries[path]
+                self.total -= size
+                self.evicted += 1
+                self.evicted_bytes += size
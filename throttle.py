@@ -0,0 +1,150 @@
+"""
+Bandwidth and concurrency limits shared by all of the download connections.
+"""
+
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket(object):
+    """
+    Limits the rate of bytes passing through, with bursts of up to capacity bytes.
+    Takes that would overdraw the bucket put it into debt, and the caller sleeps until the debt is paid back. This keeps
+    the long-term rate exact even when blocks are larger than the capacity.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError('Rate must be positive')
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate  # One second worth of burst by default.
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ConcurrencyController(object):
+    """
+    Limits how many transfers may be active at once, adjusting the limit from the measured aggregate throughput and
+    error rate.
+
+    Every interval the limit is probed one step up. If the extra transfer didn't raise throughput by at least
+    min_gain, the limit steps back down and holds there for a few intervals before probing again. An error rate above
+    max_error_rate halves the limit.
+    """
+
+    HOLD_INTERVALS = 3
+
+    def __init__(self, minimum: int, maximum: int, interval: float = 5.0, min_gain: float = 0.05,
+                 max_error_rate: float = 0.2):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = self.minimum
+        self.interval = interval
+        self.min_gain = min_gain
+        self.max_error_rate = max_error_rate
+
+        self.active = 0
+        self.condition = threading.Condition()
+
+        self.probing = False
+        self.hold = 0
+        self.previous_throughput = 0.0
+        self._start_interval(time.monotonic())
+
+    def _start_interval(self, now: float):
+        self.interval_start = now
+        self.interval_bytes = 0
+        self.interval_successes = 0
+        self.interval_errors = 0
+
+    def acquire(self):
+        """Block until a transfer may start."""
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, ok: Optional[bool]):
+        """
+        Finish a transfer started with acquire().
+        :param ok: Whether it succeeded. None if it failed in a way that says nothing about load, such as a missing
+        file, so it isn't counted either way.
+        """
+        with self.condition:
+            self.active -= 1
+            if ok:
+                self.interval_successes += 1
+            elif ok is not None:
+                self.interval_errors += 1
+            self._maybe_adjust()
+            self.condition.notify_all()
+
+    def record(self, byte_count: int):
+        """Count bytes transferred by an active transfer."""
+        with self.condition:
+            self.interval_bytes += byte_count
+            self._maybe_adjust()
+
+    def _maybe_adjust(self):
+        now = time.monotonic()
+        elapsed = now - self.interval_start
+        if elapsed < self.interval:
+            return
+
+        throughput = self.interval_bytes / elapsed
+        attempts = self.interval_successes + self.interval_errors
+        error_rate = self.interval_errors / attempts if attempts > 0 else 0.0
+        previous_limit = self.limit
+
+        if error_rate > self.max_error_rate:
+            self.limit = max(self.minimum, self.limit // 2)
+            self.probing = False
+            self.hold = self.HOLD_INTERVALS
+        elif self.probing and throughput < self.previous_throughput * (1 + self.min_gain):
+            self.limit = max(self.minimum, self.limit - 1)
+            self.probing = False
+            self.hold = self.HOLD_INTERVALS
+        elif self.hold > 0:
+            self.hold -= 1
+            self.probing = False
+        elif self.limit < self.maximum:
+            self.limit += 1
+            self.probing = True
+        else:
+            self.probing = False
+
+        if self.limit != previous_limit:
+            print(f'Adjusting active transfers from {previous_limit} to {self.limit} '
+                  f'({throughput / 1024:.1f} KiB/s, {error_rate:.0%} errors)')
+            self.condition.notify_all()
+
+        self.previous_throughput = throughput
+        self._start_interval(now)
+
+
+def parse_rate(text: str) -> int:
+    """Parse a byte rate such as 500K, 2M or 2MiB (binary units) into bytes per second."""
+    units = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+    text = text.strip().upper()
+    for suffix in ('IB', 'B'):
+        if text.endswith(suffix):
+            text = text[:-len(suffix)]
+            break
+    multiplier = 1
+    if text and text[-1] in units:
+        multiplier = units[text[-1]]
+        text = text[:-1]
+    return int(float(text) * multiplier)
@@ -0,0 +1,113 @@
+"""
+Timing of connections and transfers, written out as a JSON report so concurrency and limits can be tuned from data.
+"""
+
+import json
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    if len(values) < 1:
+        return None
+
+    ordered = sorted(values)
+
+    def rank(p: float) -> float:
+        # Nearest-rank percentile.
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+    return {
+        'min': ordered[0],
+        'p50': rank(50),
+        'p90': rank(90),
+        'p99': rank(99),
+        'max': ordered[-1],
+        'mean': sum(ordered) / len(ordered),
+    }
+
+
+class TransferStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.connect_times: List[float] = []
+        self.transfers: List[dict] = []
+        self.failures: List[dict] = []
+        self.workers: List[dict] = []
+        # Extra top level entries of the report, e.g. per-mirror figures.
+        self.sections: Dict[str, object] = {}
+
+    def add_connect(self, seconds: float):
+        with self.lock:
+            self.connect_times.append(seconds)
+
+    def add_transfer(self, name: str, offset: int, byte_count: int, setup: float, first_byte: Optional[float],
+                     duration: float):
+        """
+        :param setup: Seconds from sending RETR until the data connection was open.
+        :param first_byte: Seconds from sending RETR until the first data arrived, None for an empty transfer.
+        :param duration: Seconds from sending RETR until the transfer completed.
+        """
+        with self.lock:
+            self.transfers.append({
+                'name': name,
+                'offset': offset,
+                'bytes': byte_count,
+                'setup': setup,
+                'first_byte': first_byte,
+                'duration': duration,
+                'rate': byte_count / duration if duration > 0 else None,
+            })
+
+    def add_failure(self, name: str, error: str):
+        with self.lock:
+            self.failures.append({'name': name, 'error': error})
+
+    def add_worker(self, transferring: float, total: float):
+        """Account for a finished worker that spent transferring seconds of its total lifetime on transfers."""
+        with self.lock:
+            self.workers.append({'transferring': transferring, 'idle': max(0.0, total - transferring)})
+
+    def add_section(self, name: str, data):
+        with self.lock:
+            self.sections[name] = data
+
+    def report(self) -> dict:
+        with self.lock:
+            transfers = list(self.transfers)
+            elapsed = time.monotonic() - self.start
+            report = {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'elapsed': elapsed,
+                'connections': {
+                    'count': len(self.connect_times),
+                    'connect': percentiles(self.connect_times),
+                },
+                'transfers': {
+                    'count': len(transfers),
+                    'failed': len(self.failures),
+                    'bytes': sum(t['bytes'] for t in transfers),
+                    'rate': sum(t['bytes'] for t in transfers) / elapsed if elapsed > 0 else None,
+                    'setup': percentiles([t['setup'] for t in transfers]),
+                    'first_byte': percentiles([t['first_byte'] for t in transfers if t['first_byte'] is not None]),
+                    'duration': percentiles([t['duration'] for t in transfers]),
+                    'file_rate': percentiles([t['rate'] for t in transfers if t['rate'] is not None]),
+                },
+                'workers': {
+                    'count': len(self.workers),
+                    'transferring': sum(w['transferring'] for w in self.workers),
+                    'idle': sum(w['idle'] for w in self.workers),
+                },
+                'files': transfers,
+                'failures': list(self.failures),
+            }
+            report.update(self.sections)
+            return report
+
+    def write(self, path: str):
+        report = self.report()
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1)